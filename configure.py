@@ -9,6 +9,18 @@ import textwrap
 import argparse
 import uuid
 import glob
+import fnmatch
+import select
+import struct
+import time
+import math
+import json
+import shutil
+import tempfile
+import hashlib
+import asyncio
+import traceback
+from importlib import reload as reload_module
 
 try:
     from StringIO import StringIO
@@ -19,6 +31,16 @@ except ImportError:
 Targets = []
 Args = None
 
+# BUILD.py files reading Args.type, executed once per build type of --configs
+TypeDependentBuildFiles = set()
+
+class ArgsNamespace(argparse.Namespace):
+    """The parsed arguments, remembers the BUILD.py files reading the build type."""
+    def __getattribute__(self, name):
+        if name == 'type' and CurrLodingFilePath:
+            TypeDependentBuildFiles.add(CurrLodingFilePath)
+        return argparse.Namespace.__getattribute__(self, name)
+
 default_build_setting = None
 
 # ======================================
@@ -39,6 +61,9 @@ elif os.name == 'nt':
     OBJ_EXTENSION = '.obj'
     NINJA = '.\\ninja\\ninja-win\\ninja.exe'
 
+# files kept by configure.py between runs
+CACHE_DIR = '.configure_cache'
+
 # ======================================
 # Variables
 # ======================================
@@ -51,9 +76,12 @@ def setup_variables():
     Variables['AR'] = AR
     Variables['OBJ_EXTENSION'] = OBJ_EXTENSION
     Variables['NINJA'] = NINJA
-    Variables['BUILD_DIR'] = '.build_debug' if Args.type == 'debug' else '.build_release'
+    Variables['BUILD_DIR'] = get_build_dir(Args.type)
     Variables['CURR_DIR'] = ''
 
+def get_build_dir(build_type):
+    return '.build_debug' if build_type == 'debug' else '.build_release'
+
 def format_variables(paths):
     try:
         if type(paths) is str:
@@ -67,6 +95,114 @@ def format_variables(paths):
         sys.exit(1)
 
 
+# ======================================
+# Toolchain
+# ======================================
+class Toolchain(object):
+    """Probe the features of CC/CXX/LD once, the results are cached on disk
+    keyed on the path and mtime of the tool, so a compiler upgrade probes again.
+
+    It is exported as `toolchain` to default_build_setting.py and BUILD.py:
+        from __main__ import toolchain
+        if toolchain.ld_supports('-fuse-ld=mold'):
+            ldflags += ['-fuse-ld=mold']
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.cache = {}
+        try:
+            with open(cache_path) as f:
+                self.cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def get_tool(self, tool):
+        return {'cc':CC, 'cxx':CXX, 'ld':LD, 'ar':AR}.get(tool, tool)
+
+    def get_tool_key(self, command):
+        # skip launchers such as 'ccache g++'
+        path = shutil.which(command.split()[-1])
+        if not path:
+            return None
+        path = os.path.realpath(path)
+        return '{0}@{1}'.format(path, os.path.getmtime(path))
+
+    def probe(self, tool, name, func):
+        command = self.get_tool(tool)
+        key = self.get_tool_key(command)
+        if key is None:
+            return None
+        results = self.cache.setdefault(key, {})
+        if name not in results:
+            results[name] = func(command.split()[-1])
+            self.save()
+        return results[name]
+
+    def save(self):
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.cache, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+    def run(self, args):
+        try:
+            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.PIPE)
+            output = p.communicate()[0].decode(errors='replace')
+            return p.returncode, output
+        except OSError:
+            return -1, ''
+
+    def get_version(self, tool='cxx'):
+        """First line of `tool --version`."""
+        def version(command):
+            # cl.exe prints its banner when called without arguments
+            returncode, output = self.run([command] if os.name == 'nt' else [command, '--version'])
+            return output.strip().split('\n')[0]
+        return self.probe(tool, 'version', version)
+
+    def get_compiler_id(self, tool='cxx'):
+        """'gcc', 'clang', 'msvc' or None."""
+        if os.name == 'nt':
+            return 'msvc'
+        def compiler_id(command):
+            returncode, output = self.run([command, '-v'])
+            if 'clang version' in output:
+                return 'clang'
+            if 'gcc version' in output:
+                return 'gcc'
+            return None
+        return self.probe(tool, 'compiler_id', compiler_id)
+
+    def try_compile(self, command, flags, lang, link):
+        tmp_dir = tempfile.mkdtemp(prefix='configure-probe-')
+        try:
+            src = os.path.join(tmp_dir, 'probe.c' if lang == 'c' else 'probe.cpp')
+            out = os.path.join(tmp_dir, 'probe.out')
+            with open(src, 'w') as f:
+                f.write('int main() { return 0; }\n')
+            if os.name == 'nt':
+                returncode, output = self.run([command, '/nologo', '/WX'] + flags + ([] if link else ['/c']) + [src, '/Fe' + out, '/Fo' + out])
+                # cl.exe only warns about unknown options
+                return returncode == 0 and 'D9002' not in output
+            returncode, output = self.run([command, '-Werror'] + flags + ([] if link else ['-c']) + [src, '-o', out])
+            return returncode == 0
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def cc_supports(self, flag):
+        return bool(self.probe('cc', 'cflag:' + flag, lambda command: self.try_compile(command, [flag], 'c', False)))
+
+    def cxx_supports(self, flag):
+        return bool(self.probe('cxx', 'cxxflag:' + flag, lambda command: self.try_compile(command, [flag], 'c++', False)))
+
+    def ld_supports(self, flag):
+        return bool(self.probe('ld', 'ldflag:' + flag, lambda command: self.try_compile(command, [flag], 'c++', True)))
+
+toolchain = None
+
 # ======================================
 # Vcxproj
 # ======================================
@@ -78,8 +214,13 @@ class Vcxproj(object):
         self.root_namespace = filename
         self.platforms = ['Win32', 'x64']
         self.configurations = ['Debug', 'Release']
-        self.guid = uuid.uuid5(uuid.NAMESPACE_URL, filepath)
+        self.guid = '{' + str(uuid.uuid5(uuid.NAMESPACE_URL, filepath)).upper() + '}'
         self.cxxflags = []
+        self.configuration_type = 'Application'
+        self.multi_processor_compilation = True
+        self.pch = None             # 预编译头文件
+        self.enable_unity = False
+        self.project_references = [] # (vcxproj路径, guid)
         
         self.cl_include = []
         self.cl_compile = []
@@ -119,7 +260,9 @@ class Vcxproj(object):
         for configuration in self.configurations:
             for platform in self.platforms:
                 ap('  <PropertyGroup Condition="\'$(Configuration)|$(Platform)\'==\'{0}|{1}\'" Label="Configuration">'.format(configuration, platform))
-                ap('    <ConfigurationType>Application</ConfigurationType>')
+                ap('    <ConfigurationType>{0}</ConfigurationType>'.format(self.configuration_type))
+                if self.enable_unity:
+                    ap('    <EnableUnitySupport>true</EnableUnitySupport>')
                 ap('    <UseDebugLibraries>{0}</UseDebugLibraries>'.format(configuration=='Debug'))
                 ap('    <CharacterSet>Unicode</CharacterSet>')
                 ap('    <PlatformToolset>v143</PlatformToolset>')
@@ -151,6 +294,16 @@ class Vcxproj(object):
                 ap('      <LanguageStandard>{0}</LanguageStandard>'.format(self.get_cppstd()))
                 ap('      <AdditionalIncludeDirectories>{0};%(AdditionalIncludeDirectories)</AdditionalIncludeDirectories>'.format(';'.join(self.additional_include_dirctories)))
                 ap('      <PreprocessorDefinitions>{0};%(PreprocessorDefinitions)</PreprocessorDefinitions>'.format(';'.join(self.preprocessor_definitions)))
+                ap('      <MultiProcessorCompilation>{0}</MultiProcessorCompilation>'.format(str(self.multi_processor_compilation).lower()))
+                if self.pch:
+                    ap('      <PrecompiledHeader>Use</PrecompiledHeader>')
+                    ap('      <PrecompiledHeaderFile>{0}</PrecompiledHeaderFile>'.format(self.pch))
+                    ap('      <ForcedIncludeFiles>{0};%(ForcedIncludeFiles)</ForcedIncludeFiles>'.format(self.pch))
+                if self.enable_unity:
+                    ap('      <IncludeInUnityFile>true</IncludeInUnityFile>')
+                    ap('      <CombineFilesOnlyFromTheSameFolder>false</CombineFilesOnlyFromTheSameFolder>')
+                    ap('      <MinFilesInUnityFile>2</MinFilesInUnityFile>')
+                    ap('      <MaxFilesInUnityFile>{0}</MaxFilesInUnityFile>'.format(UNITY_SOURCE_SIZE))
                 ap('    </ClCompile>')
                 ap('    <Link>')
                 ap('      <GenerateDebugInformation>true</GenerateDebugInformation>')
@@ -165,13 +318,78 @@ class Vcxproj(object):
         ap('  <ItemGroup>')
         for src in self.cl_compile:
             ap('    <ClCompile Include="{0}" />'.format(src))
+        if self.pch:
+            # the source creating the precompiled header
+            ap('    <ClCompile Include="{0}">'.format(self.get_pch_source()))
+            ap('      <PrecompiledHeader>Create</PrecompiledHeader>')
+            ap('      <IncludeInUnityFile>false</IncludeInUnityFile>')
+            ap('    </ClCompile>')
         ap('  </ItemGroup>')
+        if self.project_references:
+            ap('  <ItemGroup>')
+            for path, guid in self.project_references:
+                ap('    <ProjectReference Include="{0}">'.format(os.path.relpath(path, os.path.dirname(self.filepath))))
+                ap('      <Project>{0}</Project>'.format(guid))
+                ap('    </ProjectReference>')
+            ap('  </ItemGroup>')
         ap('  <Import Project="$(VCTargetsPath)\Microsoft.Cpp.targets" />')
         ap('  <ImportGroup Label="ExtensionTargets">')
         ap('  </ImportGroup>')
         ap('</Project>')
         return '\n'.join(content)
 
+    def get_pch_source(self):
+        return os.path.splitext(self.filepath)[0] + '.pch.cpp'
+
+    def generate(self):
+        with open(self.filepath, 'w') as f:
+            f.write(self.get_content())
+        if self.pch:
+            with open(self.get_pch_source(), 'w') as f:
+                f.write('#include "{0}"\n'.format(self.pch))
+
+class Sln(object):
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.platforms = ['Win32', 'x64']
+        self.configurations = ['Debug', 'Release']
+        self.projects = []  # (name, vcxproj路径, guid, 依赖的guid)
+
+    def get_content(self):
+        content = []
+        ap = content.append
+
+        vcxproj_type = '{8BC9CEB8-8B4A-11D0-8D11-00A0C91BC942}'
+        ap('Microsoft Visual Studio Solution File, Format Version 12.00')
+        ap('# Visual Studio Version 17')
+        ap('VisualStudioVersion = 17.0.31903.59')
+        ap('MinimumVisualStudioVersion = 10.0.40219.1')
+        for name, path, guid, dependencies in self.projects:
+            path = os.path.relpath(path, os.path.dirname(os.path.abspath(self.filepath))).replace('/', '\\')
+            ap('Project("{0}") = "{1}", "{2}", "{3}"'.format(vcxproj_type, name, path, guid))
+            if dependencies:
+                ap('\tProjectSection(ProjectDependencies) = postProject')
+                for dependency in dependencies:
+                    ap('\t\t{0} = {0}'.format(dependency))
+                ap('\tEndProjectSection')
+            ap('EndProject')
+        ap('Global')
+        ap('\tGlobalSection(SolutionConfigurationPlatforms) = preSolution')
+        for configuration in self.configurations:
+            for platform in self.platforms:
+                ap('\t\t{0}|{1} = {0}|{1}'.format(configuration, platform))
+        ap('\tEndGlobalSection')
+        ap('\tGlobalSection(ProjectConfigurationPlatforms) = postSolution')
+        for name, path, guid, dependencies in self.projects:
+            for configuration in self.configurations:
+                for platform in self.platforms:
+                    ap('\t\t{0}.{1}|{2}.ActiveCfg = {1}|{2}'.format(guid, configuration, platform))
+                    ap('\t\t{0}.{1}|{2}.Build.0 = {1}|{2}'.format(guid, configuration, platform))
+        ap('\tEndGlobalSection')
+        ap('EndGlobal')
+        return '\n'.join(content) + '\n'
+
     def generate(self):
         with open(self.filepath, 'w') as f:
             f.write(self.get_content())
@@ -187,10 +405,13 @@ use Python.
 """
 
 def escape_path(word):
+    if ' ' not in word and ':' not in word:
+        return word
     return word.replace('$ ', '$$ ').replace(' ', '$ ').replace(':', '$:')
 
 class NinjaWriter(object):
     def __init__(self, output, width=144):
+        # width=None: no wrapping, for the manifests only read by ninja
         self.output = output
         self.width = width
 
@@ -198,6 +419,9 @@ class NinjaWriter(object):
         self.output.write('\n')
 
     def comment(self, text):
+        if not self.width:
+            self.output.write('# ' + text + '\n')
+            return
         for line in textwrap.wrap(text, self.width - 2, break_long_words=False,
                                   break_on_hyphens=False):
             self.output.write('# ' + line + '\n')
@@ -255,12 +479,13 @@ class NinjaWriter(object):
             out_outputs.append('|')
             out_outputs.extend(implicit_outputs)
 
-        self._line('build %s: %s' % (' '.join(out_outputs),
-                                     ' '.join([rule] + all_inputs)))
+        # one write for the whole build statement
+        lines = [self._wrap('build %s: %s' % (' '.join(out_outputs),
+                                              ' '.join([rule] + all_inputs)))]
         if pool is not None:
-            self._line('  pool = %s' % pool)
+            lines.append(self._wrap('  pool = %s' % pool))
         if dyndep is not None:
-            self._line('  dyndep = %s' % dyndep)
+            lines.append(self._wrap('  dyndep = %s' % dyndep))
 
         if variables:
             if isinstance(variables, dict):
@@ -269,8 +494,13 @@ class NinjaWriter(object):
                 iterator = iter(variables)
 
             for key, val in iterator:
-                self.variable(key, val, indent=1)
+                if val is None:
+                    continue
+                if isinstance(val, list):
+                    val = ' '.join(filter(None, val))
+                lines.append(self._wrap('%s = %s' % (key, val), 1))
 
+        self.output.write(''.join(lines))
         return outputs
 
     def include(self, path):
@@ -282,50 +512,50 @@ class NinjaWriter(object):
     def default(self, paths):
         self._line('default %s' % ' '.join(as_list(paths)))
 
-    def _count_dollars_before_index(self, s, i):
-        """Returns the number of '$' characters right in front of s[i]."""
-        dollar_count = 0
-        dollar_index = i - 1
-        while dollar_index > 0 and s[dollar_index] == '$':
-            dollar_count += 1
-            dollar_index -= 1
-        return dollar_count
-
     def _line(self, text, indent=0):
         """Write 'text' word-wrapped at self.width characters."""
+        self.output.write(self._wrap(text, indent))
+
+    def _wrap(self, text, indent=0):
+        """Return 'text' word-wrapped at self.width characters, a width of
+        None or 0 disables the wrapping."""
         leading_space = '  ' * indent
-        while len(leading_space) + len(text) > self.width:
-            # The text is too wide; wrap if possible.
+        if not self.width or len(leading_space) + len(text) <= self.width:
+            return leading_space + text + '\n'
 
-            # Find the rightmost space that would obey our width constraint and
-            # that's not an escaped space.
+        # Split once at the spaces which are not escaped by an odd number of '$'.
+        if '$' not in text:
+            words = text.split(' ')
+        else:
+            words = []
+            start = 0
+            for m in re.finditer(r'(\$*) ', text):
+                if len(m.group(1)) % 2 == 0:
+                    words.append(text[start:m.end() - 1])
+                    start = m.end()
+            words.append(text[start:])
+
+        # Break at the rightmost space that would obey our width constraint,
+        # or after the first word if it is too long already.
+        lines = []
+        rest = len(text)
+        i = 0
+        while i < len(words) - 1 and len(leading_space) + rest > self.width:
             available_space = self.width - len(leading_space) - len(' $')
-            space = available_space
-            while True:
-                space = text.rfind(' ', 0, space)
-                if (space < 0 or
-                    self._count_dollars_before_index(text, space) % 2 == 0):
-                    break
-
-            if space < 0:
-                # No such space; just use the first unescaped space we can find.
-                space = available_space - 1
-                while True:
-                    space = text.find(' ', space + 1)
-                    if (space < 0 or
-                        self._count_dollars_before_index(text, space) % 2 == 0):
-                        break
-            if space < 0:
-                # Give up on breaking.
-                break
-
-            self.output.write(leading_space + text[0:space] + ' $\n')
-            text = text[space+1:]
+            length = len(words[i])
+            j = i + 1
+            while j < len(words) - 1 and length + 1 + len(words[j]) < available_space:
+                length += 1 + len(words[j])
+                j += 1
+            lines.append(leading_space + ' '.join(words[i:j]) + ' $\n')
+            rest -= length + 1
+            i = j
 
             # Subsequent lines are continuations, so indent them.
             leading_space = '  ' * (indent+2)
 
-        self.output.write(leading_space + text + '\n')
+        lines.append(leading_space + ' '.join(words[i:]) + '\n')
+        return ''.join(lines)
 
     def close(self):
         self.output.close()
@@ -359,6 +589,334 @@ def expand(string, vars, local_vars={}):
         return local_vars.get(var, vars.get(var, ''))
     return re.sub(r'\$(\$|\w*)', exp, string)
 
+# ======================================
+# Build Graph
+# ======================================
+class Edge(object):
+    def __init__(self, outputs, rule, inputs, implicit, order_only, implicit_outputs, variables, pool, dyndep, owner):
+        self.outputs = outputs
+        self.rule = rule
+        self.inputs = inputs
+        self.implicit = implicit
+        self.order_only = order_only
+        self.implicit_outputs = implicit_outputs
+        self.variables = variables
+        self.pool = pool
+        self.dyndep = dyndep
+        self.owner = owner      # 生成该edge的user target
+
+    def get_outputs(self):
+        return self.outputs + self.implicit_outputs
+
+    def get_inputs(self):
+        """Inputs whose changes make the outputs dirty."""
+        return self.inputs + self.implicit
+
+class GraphWriter(NinjaWriter):
+    """NinjaWriter which also keeps the pools, rules and edges in memory."""
+
+    def __init__(self, output, width=144):
+        super(GraphWriter, self).__init__(output, width)
+        self.pools = {}
+        self.rules = {}
+        self.edges = []
+        self.defaults = []
+
+    def pool(self, name, depth):
+        self.pools[name] = int(depth)
+        super(GraphWriter, self).pool(name, depth)
+
+    def rule(self, name, command, description=None, depfile=None,
+             generator=False, pool=None, restat=False, rspfile=None,
+             rspfile_content=None, deps=None):
+        self.rules[name] = {'command':command, 'description':description, 'depfile':depfile,
+                            'generator':generator, 'pool':pool, 'restat':restat, 'rspfile':rspfile,
+                            'rspfile_content':rspfile_content, 'deps':deps}
+        super(GraphWriter, self).rule(name, command, description, depfile, generator, pool,
+                                      restat, rspfile, rspfile_content, deps)
+
+    def build(self, outputs, rule, inputs=None, implicit=None, order_only=None,
+              variables=None, implicit_outputs=None, pool=None, dyndep=None):
+        if isinstance(variables, dict):
+            edge_variables = dict(variables)
+        else:
+            edge_variables = dict(variables or [])
+        for k, v in edge_variables.items():
+            if isinstance(v, list):
+                edge_variables[k] = ' '.join(filter(None, v))
+        self.edges.append(Edge(list(as_list(outputs)), rule, list(as_list(inputs)), list(as_list(implicit)),
+                               list(as_list(order_only)), list(as_list(implicit_outputs)), edge_variables,
+                               pool, dyndep, CurrGeneratingTarget))
+        return super(GraphWriter, self).build(outputs, rule, inputs, implicit, order_only,
+                                              variables, implicit_outputs, pool, dyndep)
+
+    def default(self, paths):
+        self.defaults += as_list(paths)
+        super(GraphWriter, self).default(paths)
+
+# the user target being generated, owner of the new edges
+CurrGeneratingTarget = None
+
+# ======================================
+# Ninja Log
+# ======================================
+NinjaLogCache = {}
+
+def read_ninja_log(path='.ninja_log'):
+    """Parse .ninja_log, returns {output: (start_ms, end_ms, mtime, command_hash)}."""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return {}
+    if path in NinjaLogCache and NinjaLogCache[path][0] == mtime:
+        return NinjaLogCache[path][1]
+
+    entries = {}
+    with open(path) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 5:
+                continue
+            # later entries of the same output override the former ones
+            entries[fields[3]] = (int(fields[0]), int(fields[1]), int(fields[2]), fields[4])
+    NinjaLogCache[path] = (mtime, entries)
+    return entries
+
+def read_ninja_deps(path='.ninja_deps'):
+    """Parse .ninja_deps, returns {output: (inputs, mtime)}."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return {}
+    signature = b'# ninjadeps\n'
+    if not data.startswith(signature) or len(data) < len(signature) + 4:
+        return {}
+    offset = len(signature)
+    version = struct.unpack_from('<i', data, offset)[0]
+    offset += 4
+    if version not in (3, 4):
+        return {}
+
+    paths = []
+    deps = {}
+    while offset + 4 <= len(data):
+        size = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        is_deps = size >> 31
+        size &= 0x7fffffff
+        record = data[offset:offset+size]
+        offset += size
+        if len(record) < size:
+            break   # truncated by an interrupted build
+        if is_deps:
+            if version == 3:
+                out_id, mtime = struct.unpack_from('<iI', record)
+                ids = record[8:]
+            else:
+                out_id, mtime = struct.unpack_from('<iQ', record)
+                ids = record[12:]
+            ids = struct.unpack('<%di' % (len(ids) // 4), ids)
+            if out_id < len(paths):
+                deps[paths[out_id]] = ([paths[i] for i in ids if i < len(paths)], mtime)
+        else:
+            # path padded by '\0' to 4 bytes, followed by a checksum
+            paths.append(record[:-4].rstrip(b'\0').decode())
+    return deps
+
+# ======================================
+# Time Trace
+# ======================================
+# clang -ftime-trace writes <object without extension>.json, gcc -ftime-report
+# prints its report to stderr which is kept in <object>.ftr
+def get_time_trace(tool, target):
+    """Returns the extra flags and the trace file of a compile edge."""
+    if not Args.time_trace or os.name != 'posix':
+        return [], None
+    compiler_id = toolchain.get_compiler_id(tool)
+    if compiler_id == 'clang':
+        return ['-ftime-trace'], os.path.splitext(target)[0] + '.json'
+    elif compiler_id == 'gcc':
+        return ['-ftime-report'], target + '.ftr'
+    return [], None
+
+def get_time_trace_command(tool, command):
+    if Args.time_trace and os.name == 'posix' and toolchain.get_compiler_id(tool) == 'gcc':
+        # forward the diagnostics, drop the report
+        return ("( {0} 2> $out.ftr; status=$$?; awk '/^Time variable/{{exit}} NF{{print}}' $out.ftr >&2; "
+                "exit $$status )").format(command)
+    return command
+
+# clang trace event => category
+TIME_TRACE_EVENTS = {
+    'Source': 'include',
+    'ParseClass': 'parse',
+    'InstantiateClass': 'instantiate',
+    'InstantiateFunction': 'instantiate',
+    'OptFunction': 'optimize',
+    'CodeGen Function': 'codegen',
+}
+
+def read_time_trace(path):
+    """Returns {(category, detail): milliseconds} of a trace file."""
+    costs = {}
+    if path.endswith('.json'):
+        with open(path) as f:
+            events = json.load(f).get('traceEvents', [])
+        for event in events:
+            category = TIME_TRACE_EVENTS.get(event.get('name'))
+            if category and 'dur' in event:
+                key = (category, event.get('args', {}).get('detail', ''))
+                costs[key] = costs.get(key, 0) + event['dur'] / 1000.0
+    else:
+        with open(path) as f:
+            for line in f:
+                m = re.match(r'^ (.+?)\s+:\s+[\d.]+ \(\s*\d+%\)\s+[\d.]+ \(\s*\d+%\)\s+([\d.]+) \(', line)
+                if m:
+                    key = ('phase', m.group(1).strip())
+                    costs[key] = costs.get(key, 0) + float(m.group(2)) * 1000
+    return costs
+
+def report_time_trace(graph, top=20):
+    """Rank the most expensive includes, instantiations and phases per user target."""
+    project = {}
+    targets = []
+    target_costs = {}
+    for edge in graph.edges:
+        if edge.rule not in COMPILE_RULES:
+            continue
+        flags, trace = get_time_trace('cc' if edge.rule == 'cc' else 'cxx', edge.outputs[0])
+        if trace not in edge.implicit_outputs or not os.path.exists(trace):
+            continue
+        if edge.owner not in target_costs:
+            targets.append(edge.owner)
+            target_costs[edge.owner] = {}
+        for key, cost in read_time_trace(trace).items():
+            for costs in (project, target_costs[edge.owner]):
+                total, count = costs.get(key, (0, 0))
+                costs[key] = (total + cost, count + 1)
+
+    def print_costs(title, costs):
+        print('=== {0} ==='.format(title))
+        for (category, detail), (total, count) in sorted(costs.items(), key=lambda x: -x[1][0])[:top]:
+            print('{0:>10.1f} ms  {1:<12} {2:>5} TU  {3}'.format(total, category, count, detail))
+        print('')
+
+    if not project:
+        print('No trace files found, build with --time-trace first')
+        return 1
+    print_costs('project', project)
+    for target in targets:
+        print_costs('{0} ({1})'.format(target.__class__.__name__, format_variables(target.name)), target_costs[target])
+    return 0
+
+# ======================================
+# Resource Usage
+# ======================================
+# --resource-usage runs the commands of the compile, link, archive and unity
+# edges through a wrapper which records their cpu time, peak RSS and disk I/O
+# (getrusage of the children) into a sqlite database in BUILD_DIR, passed to
+# every edge as $resource_db as the rules are shared by all the build types of
+# --configs. The command is passed in a ninja rspfile, so it is not quoted again.
+RESOURCE_SCRIPT = 'record_resource_usage.py'
+
+def get_resource_db():
+    return os.path.join(Variables['BUILD_DIR'], 'resource_usage.db')
+
+def resource_usage_rule(writer, name, command, **kwargs):
+    """writer.rule(), recording the resource usage of the edges with --resource-usage."""
+    if Args.resource_usage and os.name == 'posix':
+        kwargs['rspfile'] = '$out.cmd'
+        kwargs['rspfile_content'] = command
+        command = 'python {0} $resource_db $out $out.cmd'.format(RESOURCE_SCRIPT)
+    writer.rule(name, command, **kwargs)
+
+def resource_usage_variables(variables):
+    """The variables of an edge of a resource_usage_rule()."""
+    if Args.resource_usage and os.name == 'posix':
+        variables = dict(variables, resource_db=get_resource_db())
+    return variables
+
+def write_resource_script():
+    with open(RESOURCE_SCRIPT, 'w') as f:
+        content = '''
+import sys
+import time
+import sqlite3
+import resource
+import subprocess
+
+db, output, command_file = sys.argv[1:4]
+with open(command_file) as f:
+    command = f.read()
+start = time.time()
+returncode = subprocess.call(command, shell=True)
+wall = time.time() - start
+
+# the shell and all the processes it waited for
+usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+maxrss_kb = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+if returncode == 0:
+    try:
+        conn = sqlite3.connect(db, timeout=60)
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS edges (output TEXT PRIMARY KEY, start REAL, wall REAL, '
+                         'user REAL, sys REAL, maxrss_kb INTEGER, read_bytes INTEGER, written_bytes INTEGER)')
+            conn.execute('INSERT OR REPLACE INTO edges VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (output, start, wall, usage.ru_utime, usage.ru_stime, maxrss_kb,
+                          usage.ru_inblock * 512, usage.ru_oublock * 512))
+        conn.close()
+    except sqlite3.Error as e:
+        sys.stderr.write('resource usage of {0} is not recorded: {1}\\n'.format(output, e))
+sys.exit(returncode if returncode >= 0 else 128 - returncode)
+'''
+        f.write(content)
+
+def report_resource_usage(graph, top=10):
+    """List the heaviest edges of every user target."""
+    dbs = [os.path.join(get_build_dir(t), 'resource_usage.db') for t in Args.configs or [Args.type]]
+    dbs = [db for db in dbs if os.path.exists(db)]
+    if not dbs:
+        print('No resource usage recorded, build with --resource-usage first')
+        return 1
+    import sqlite3
+    rows = {}
+    for db in dbs:
+        conn = sqlite3.connect(db)
+        rows.update((row[0], row[1:]) for row in
+                    conn.execute('SELECT output, wall, user, sys, maxrss_kb, read_bytes, written_bytes FROM edges'))
+        conn.close()
+
+    targets = []
+    target_edges = {}
+    for edge in graph.edges:
+        if edge.owner is None or not edge.outputs or edge.outputs[0] not in rows:
+            continue
+        if edge.owner not in target_edges:
+            targets.append(edge.owner)
+            target_edges[edge.owner] = []
+        target_edges[edge.owner].append((edge.outputs[0],) + rows[edge.outputs[0]])
+
+    if not targets:
+        print('No resource usage of the current targets, build with --resource-usage first')
+        return 1
+    # heaviest targets first
+    cpu = lambda x: x[2] + x[3]
+    targets.sort(key=lambda t: -sum(cpu(x) for x in target_edges[t]))
+    for target in targets:
+        edges = target_edges[target]
+        print('=== {0} ({1}): {2:.1f} s cpu, {3:.0f} MB peak RSS, {4} edges ==='.format(
+            target.__class__.__name__, format_variables(target.name), sum(cpu(x) for x in edges),
+            max(x[4] for x in edges) / 1024.0, len(edges)))
+        print('{0:>8} {1:>8} {2:>9} {3:>9} {4:>9}  {5}'.format('cpu s', 'wall s', 'rss MB', 'read MB', 'write MB', 'output'))
+        for x in sorted(edges, key=lambda x: -cpu(x))[:top]:
+            print('{0:>8.2f} {1:>8.2f} {2:>9.1f} {3:>9.1f} {4:>9.1f}  {5}'.format(
+                cpu(x), x[1], x[4] / 1024.0, x[5] / 1048576.0, x[6] / 1048576.0, x[0]))
+        print('')
+    return 0
+
 # ======================================
 # CcTarget
 # ======================================
@@ -375,7 +933,8 @@ class CcTarget(object):
     @classmethod
     def generate_ninja_rule(cls, writer):
         if os.name == 'posix':
-            writer.rule('cc', '{cc} -o $out -c $in -MMD -MF $in.d $cflags $incs $defs'.format(cc=CC), description='CC $in', depfile='$in.d', deps='gcc')
+            command = get_time_trace_command('cc', '{cc} -o $out -c $in -MMD -MF $out.d $cflags $incs $defs'.format(cc=CC))
+            resource_usage_rule(writer, 'cc', command, description='CC $in', depfile='$out.d', deps='gcc')
         elif os.name == 'nt':
             writer.rule('cc', '{cc} /showIncludes /Fo$out -c $in $cflags $incs $defs'.format(cc=CC), description='CC $in', deps='msvc')
         writer.newline()
@@ -390,7 +949,8 @@ class CcTarget(object):
         target = format_variables(self.name)
         incs = format_variables(self.incs)
         src = format_variables(self.src)
-        cflags = ' '.join(self.cflags)
+        time_trace_flags, time_trace = get_time_trace('cc', target)
+        cflags = ' '.join(self.cflags + time_trace_flags)
         
         if os.name == 'posix':
             incs = ' '.join(['-I' + inc for inc in incs])
@@ -399,7 +959,7 @@ class CcTarget(object):
             incs = ' '.join(['/I' + inc for inc in incs])
             defs = ' '.join(['/D ' + define for define in self.defs])
         writer.comment('=== build cc target: {target} ==='.format(target=target))
-        writer.build(target, 'cc', inputs=src, variables={'cflags':cflags, 'incs':incs, 'defs':defs})
+        writer.build(target, 'cc', inputs=src, implicit_outputs=time_trace, variables=resource_usage_variables({'cflags':cflags, 'incs':incs, 'defs':defs}))
         writer.newline()
 
 # ======================================
@@ -418,7 +978,8 @@ class CxxTarget(object):
     @classmethod
     def generate_ninja_rule(cls, writer):
         if os.name == 'posix':
-            writer.rule('cxx', '{cxx} -o $out -c $in -MMD -MF $in.d $cxxflags $incs $defs'.format(cxx=CXX), description='CXX $in', depfile='$in.d', deps='gcc')
+            command = get_time_trace_command('cxx', '{cxx} -o $out -c $in -MMD -MF $out.d $cxxflags $incs $defs'.format(cxx=CXX))
+            resource_usage_rule(writer, 'cxx', command, description='CXX $in', depfile='$out.d', deps='gcc')
         elif os.name == 'nt':
             writer.rule('cxx', '{cxx} /showIncludes /Fo$out -c $in $cxxflags $incs $defs'.format(cxx=CXX), description='CXX $in', deps='msvc')
         writer.newline()
@@ -433,7 +994,8 @@ class CxxTarget(object):
         target = format_variables(self.name)
         incs = format_variables(self.incs)
         src = format_variables(self.src)
-        cxxflags = ' '.join(self.cxxflags)
+        time_trace_flags, time_trace = get_time_trace('cxx', target)
+        cxxflags = ' '.join(self.cxxflags + time_trace_flags)
         
         if os.name == 'posix':
             incs = ' '.join(['-I' + inc for inc in incs])
@@ -442,7 +1004,7 @@ class CxxTarget(object):
             incs = ' '.join(['/I' + inc for inc in incs])
             defs = ' '.join(['/D ' + define for define in self.defs])
         writer.comment('=== build cxx target: {target} ==='.format(target=target))
-        writer.build(target, 'cxx', inputs=src, variables={'cxxflags':cxxflags, 'incs':incs, 'defs':defs})
+        writer.build(target, 'cxx', inputs=src, implicit_outputs=time_trace, variables=resource_usage_variables({'cxxflags':cxxflags, 'incs':incs, 'defs':defs}))
         writer.newline()
 
 # ======================================
@@ -461,21 +1023,99 @@ class LinkTarget(object):
     @classmethod
     def generate_ninja_rule(cls, writer):
         if os.name == 'posix':
-            writer.rule('link', '{ld} -o $out $in $libs $ldflags'.format(ld=LD), description='LINK $out')
+            resource_usage_rule(writer, 'link', '{ld} -o $out $in $libs $ldflags'.format(ld=LD), description='LINK $out')
         elif os.name == 'nt':
             writer.rule('link', '{ld} /OUT:$out $in $libs $ldflags'.format(ld=LD), description='LINK $out')
         writer.newline()
     
     def generate_ninja_build(self, writer):
         target = format_variables(self.name)
-        libs = format_variables(self.libs)
-        deps = format_variables(self.deps)
+        libs, rpaths = get_link_libs(target, format_variables(self.libs))
+        deps = get_link_deps(format_variables(self.deps))
         objs = format_variables(self.objs)
-        ldflags = ' '.join(self.ldflags)
+        ldflags = ' '.join(self.ldflags + rpaths)
         writer.comment('=== build link target: {target} ==='.format(target=target))
-        writer.build(target, 'link', inputs=objs, variables={'ldflags':ldflags, 'libs':libs}, implicit=deps)
+        writer.build(target, 'link', inputs=objs, variables=resource_usage_variables({'ldflags':ldflags, 'libs':libs}), implicit=deps)
         writer.newline()
 
+# ======================================
+# SolinkTarget
+# ======================================
+# table of contents of a shared library: the exported symbols, it is only
+# rewritten when they change, so dependents do not relink (restat) when
+# only the implementation of the shared library changed
+TOC_EXTENSION = '.TOC'
+
+class SolinkTarget(LinkTarget):
+    def __init__(self):
+        super(SolinkTarget, self).__init__()
+
+    @classmethod
+    def generate_ninja_rule(cls, writer):
+        if os.name == 'posix':
+            command = ('{ld} -o $lib $in $libs $ldflags && '
+                       '{{ readelf -d $lib | grep SONAME ; nm -gD -f p $lib | cut -f1-2 -d" "; }} > $out.tmp && '
+                       'if ! cmp -s $out.tmp $out; then mv $out.tmp $out; else rm -f $out.tmp; fi').format(ld=LD)
+            resource_usage_rule(writer, 'solink', command, description='SOLINK $lib', restat=True)
+            writer.newline()
+
+    def generate_ninja_build(self, writer):
+        target = format_variables(self.name)
+        libs, rpaths = get_link_libs(target, format_variables(self.libs))
+        deps = get_link_deps(format_variables(self.deps))
+        objs = format_variables(self.objs)
+        ldflags = ' '.join(self.ldflags + rpaths)
+        writer.comment('=== build solink target: {target} ==='.format(target=target))
+        writer.build(target + TOC_EXTENSION, 'solink', inputs=objs, implicit=deps, implicit_outputs=target,
+                     variables=resource_usage_variables({'ldflags':ldflags, 'libs':libs, 'lib':target}))
+        writer.newline()
+
+# (components, shared libraries) of the configuration being generated
+LinkLibraries = None
+
+def collect_link_libraries():
+    """Collect the libraries linked through a TOC once per configuration."""
+    components = get_component_libraries()
+    shared_libraries = set(t.get_output() for t in Targets if isinstance(t, SharedLibraryTarget)) | set(components.values())
+    return components, shared_libraries
+
+def get_link_libraries():
+    return LinkLibraries if LinkLibraries is not None else collect_link_libraries()
+
+def get_link_deps(deps):
+    """Depend on the TOC instead of the shared library itself when linking."""
+    if os.name != 'posix':
+        return deps
+    components, shared_libraries = get_link_libraries()
+    deps = [components.get(dep, dep) for dep in deps]
+    return [dep + TOC_EXTENSION if dep in shared_libraries else dep for dep in deps]
+
+def get_link_libs(target, libs):
+    """Link the components instead of the static libraries, returns libs and the rpath flags to find them."""
+    components, shared_libraries = get_link_libraries()
+    rpaths = []
+    for lib in libs:
+        if lib in components:
+            directory = os.path.relpath(os.path.dirname(components[lib]), os.path.dirname(target))
+            rpath = "-Wl,-rpath,'$$ORIGIN/{0}'".format(directory)
+            if rpath not in rpaths:
+                rpaths.append(rpath)
+    return [components.get(lib, lib) for lib in libs], rpaths
+
+# ======================================
+# Component Build
+# ======================================
+# --link-mode=component builds the static libraries of debug builds as shared
+# libraries, so an edit relinks one small library instead of every executable
+def is_component_build():
+    return os.name == 'posix' and Args.link_mode == 'component' and Args.type == 'debug'
+
+def get_component_libraries():
+    """Static library name => the shared library built instead."""
+    if not is_component_build():
+        return {}
+    return dict((format_variables(t.name), t.get_output()) for t in Targets if isinstance(t, StaticLibraryTarget))
+
 # ======================================
 # ArchivesTarget
 # ======================================
@@ -489,7 +1129,7 @@ class ArchivesTarget(object):
     @classmethod
     def generate_ninja_rule(cls, writer):
         if os.name == 'posix':
-            writer.rule('ar', '{ar} rcs $out $in'.format(ar=AR), description='AR $out')
+            resource_usage_rule(writer, 'ar', '{ar} rcs $out $in'.format(ar=AR), description='AR $out')
         elif os.name == 'nt':
             writer.rule('ar', '{ar} /OUT:$out $in'.format(ar=AR), description='AR $out')
         writer.newline()
@@ -498,7 +1138,7 @@ class ArchivesTarget(object):
         target = format_variables(self.name)
         objs = format_variables(self.objs)
         writer.comment('=== build ar target: {target} ==='.format(target=target))
-        writer.build(target, 'ar', inputs=objs)
+        writer.build(target, 'ar', inputs=objs, variables=resource_usage_variables({}))
         writer.newline()
 
 # ======================================
@@ -513,7 +1153,7 @@ class UnityTarget(object):
     
     @classmethod
     def generate_ninja_rule(cls, writer):
-        writer.rule('unity', 'python gen_unity_source.py $out $in', description='unity $out')
+        resource_usage_rule(writer, 'unity', 'python gen_unity_source.py $out $in', description='unity $out')
         writer.newline()
 
         with open('gen_unity_source.py', 'w') as f:
@@ -530,7 +1170,7 @@ with open(sys.argv[1], 'w') as f:
             self.name = os.path.join('{BUILD_DIR}', self.name)
         target = format_variables(self.name)
         writer.comment('=== build unity target: {target} ==='.format(target=target))
-        writer.build(target, 'unity', inputs=self.srcs)
+        writer.build(target, 'unity', inputs=self.srcs, variables=resource_usage_variables({}))
         writer.newline()
 
 # how many source file will be merged into an unity file
@@ -574,6 +1214,260 @@ def get_unity_targets(path, srcs):
     
     return unity_targets
 
+# ======================================
+# CxxModuleTarget
+# ======================================
+# C++20 modules (gcc -fmodules-ts): sources are scanned for the modules
+# they provide and import, the scan results of a user target are collated
+# into a ninja dyndep file which adds the BMI (.gcm) of every module as an
+# output of its interface unit and an input of its importers
+BMI_DIR = os.path.join('{BUILD_DIR}', 'gcm.cache')
+MODULE_SCRIPT = 'cxx_module_deps.py'
+
+class CxxModuleTarget(CxxTarget):
+    def __init__(self):
+        super(CxxModuleTarget, self).__init__()
+
+        self.dyndep = None      # dyndep文件
+        self.module_map = None  # module => BMI 映射文件
+
+    @classmethod
+    def generate_ninja_rule(cls, writer):
+        if os.name == 'posix':
+            # gcc adds make rules of the modules to the depfile, keep the object rule only
+            command = get_time_trace_command('cxx', '{cxx} -o $out -c -x c++ $in -MMD -MF $out.d.raw $cxxflags $incs $defs'.format(cxx=CXX))
+            resource_usage_rule(writer, 'cxx_module', command + ' && python {script} depfile $out $out.d.raw $out.d'.format(script=MODULE_SCRIPT),
+                                description='CXX $in', depfile='$out.d', deps='gcc')
+            writer.newline()
+
+    def generate_ninja_build(self, writer):
+        if not self.name.startswith('{BUILD_DIR}'):
+            self.name = os.path.join('{BUILD_DIR}', self.name)
+        # add cwd in include file
+        if not '.' in self.incs:
+            self.incs.append('.')
+
+        target = format_variables(self.name)
+        incs = ' '.join(['-I' + inc for inc in format_variables(self.incs)])
+        defs = ' '.join(['-D' + define for define in self.defs])
+        src = format_variables(self.src)
+        module_map = format_variables(self.module_map)
+        time_trace_flags, time_trace = get_time_trace('cxx', target)
+        cxxflags = ' '.join(self.cxxflags + ['-fmodules-ts', '-fmodule-mapper=' + module_map] + time_trace_flags)
+        dyndep = format_variables(self.dyndep)
+        writer.comment('=== build cxx module target: {target} ==='.format(target=target))
+        writer.build(target, 'cxx_module', inputs=src, order_only=[dyndep, module_map], dyndep=escape_path(dyndep),
+                     implicit_outputs=time_trace,
+                     variables=resource_usage_variables({'cxxflags':cxxflags, 'incs':incs, 'defs':defs}))
+        writer.newline()
+
+# ======================================
+# ModuleScanTarget
+# ======================================
+class ModuleScanTarget(object):
+    def __init__(self):
+        super(ModuleScanTarget, self).__init__()
+
+        self.name = None    # 扫描结果
+        self.src = None     # 源文件
+        self.obj = None     # 源文件对应的object
+
+    @classmethod
+    def generate_ninja_rule(cls, writer):
+        writer.rule('modscan', 'python {0} scan $in $obj $out'.format(MODULE_SCRIPT), description='SCAN $in', restat=True)
+        writer.newline()
+
+    def generate_ninja_build(self, writer):
+        target = format_variables(self.name)
+        writer.build(target, 'modscan', inputs=format_variables(self.src), variables={'obj':format_variables(self.obj)})
+        writer.newline()
+
+# ======================================
+# ModuleCollateTarget
+# ======================================
+class ModuleCollateTarget(object):
+    def __init__(self):
+        super(ModuleCollateTarget, self).__init__()
+
+        self.name = None    # 输出文件前缀: .dd .map .json
+        self.scans = []     # 本target的扫描结果
+        self.deps = []      # 依赖target的module列表(.json)
+
+    @classmethod
+    def generate_ninja_rule(cls, writer):
+        writer.rule('modcollate', 'python {0} collate $out $bmi_dir $in'.format(MODULE_SCRIPT),
+                    description='COLLATE $out', restat=True)
+        writer.newline()
+
+        with open(MODULE_SCRIPT, 'w') as f:
+            content = r"""
+import json
+import os
+import re
+import sys
+
+def write_if_changed(path, content):
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == content:
+                return
+    with open(path, 'w') as f:
+        f.write(content)
+
+def scan(src, obj, out):
+    with open(src) as f:
+        text = re.sub(r'//[^\n]*|/\*.*?\*/', ' ', f.read(), flags=re.S)
+    provides, requires = [], []
+    module = None
+    for m in re.finditer(r'^\s*(export\s+)?(module|import)\s+([\w.]*)(:[\w.]+)?\s*;', text, re.M):
+        export, kind, name, partition = m.groups()
+        if kind == 'module':
+            if not name:
+                continue    # global module fragment or private module fragment
+            module = name
+            if export or partition:
+                provides.append(name + (partition or ''))
+            else:
+                requires.append(name)   # implementation unit
+        elif name:
+            requires.append(name + (partition or ''))
+        elif partition and module:
+            requires.append(module + partition)
+    write_if_changed(out, json.dumps({'object':obj, 'provides':provides, 'requires':requires}, indent=1))
+
+def escape_path(word):
+    return word.replace('$ ', '$$ ').replace(' ', '$ ').replace(':', '$:')
+
+def collate(dd, bmi_dir, inputs):
+    prefix = os.path.splitext(dd)[0]
+    modules = {}
+    units = []
+    for path in inputs:
+        with open(path) as f:
+            if path.endswith('.json'):
+                modules.update(json.load(f)['modules'])
+            else:
+                units.append(json.load(f))
+    own = {}
+    for unit in units:
+        for name in unit['provides']:
+            own[name] = os.path.join(bmi_dir, name.replace(':', '-') + '.gcm')
+    modules.update(own)
+
+    lines = ['ninja_dyndep_version = 1']
+    for unit in units:
+        outputs = [escape_path(own[name]) for name in unit['provides']]
+        inputs = [escape_path(modules[name]) for name in unit['requires'] if name in modules and name not in unit['provides']]
+        lines.append('build {0}{1}: dyndep{2}'.format(escape_path(unit['object']),
+            ' | ' + ' '.join(outputs) if outputs else '', ' | ' + ' '.join(inputs) if inputs else ''))
+    write_if_changed(dd, '\n'.join(lines) + '\n')
+    write_if_changed(prefix + '.map', ''.join('{0} {1}\n'.format(k, v) for k, v in sorted(modules.items())))
+    write_if_changed(prefix + '.json', json.dumps({'modules':modules}, indent=1, sort_keys=True))
+
+def depfile(obj, raw, out):
+    # the first rule is the object (and BMI) depending on the source and headers
+    with open(raw) as f:
+        rule = f.read().replace('\\\n', ' ').split('\n')[0]
+    with open(out, 'w') as f:
+        f.write(obj + ':' + rule.split(':', 1)[1] + '\n')
+    os.remove(raw)
+
+if sys.argv[1] == 'scan':
+    scan(*sys.argv[2:5])
+elif sys.argv[1] == 'collate':
+    collate(sys.argv[2], sys.argv[3], sys.argv[4:])
+elif sys.argv[1] == 'depfile':
+    depfile(*sys.argv[2:5])
+"""
+            f.write(content)
+
+    def generate_ninja_build(self, writer):
+        target = format_variables(self.name)
+        writer.comment('=== build module collate target: {target} ==='.format(target=target))
+        writer.build(target + '.dd', 'modcollate', inputs=format_variables(self.scans) + format_variables(self.deps),
+                     implicit_outputs=[target + '.map', target + '.json'], variables={'bmi_dir':format_variables(BMI_DIR)})
+        writer.newline()
+
+# ======================================
+# TestRunTarget
+# ======================================
+TEST_STAMP_EXTENSION = '.passed'
+# tests or shards shorter than this are not worth another process, in milliseconds
+TEST_SHARD_MIN_RUNTIME = 1000
+
+class TestRunTarget(object):
+    def __init__(self):
+        super(TestRunTarget, self).__init__()
+
+        self.name = None    # 测试通过的标记文件
+        self.test = None    # 测试程序
+        self.args = []      # 运行参数
+        self.shard = 0      # 分片序号
+        self.shards = 1     # 分片数量
+
+    @classmethod
+    def generate_ninja_rule(cls, writer):
+        writer.pool('test_pool', Args.test_jobs or Args.jobs)
+        writer.newline()
+        if os.name == 'posix':
+            command = ('env GTEST_TOTAL_SHARDS=$shards GTEST_SHARD_INDEX=$shard $test $args > $out.log 2>&1 && touch $out '
+                       '|| { cat $out.log; exit 1; }')
+        elif os.name == 'nt':
+            command = ('cmd /c "set GTEST_TOTAL_SHARDS=$shards&& set GTEST_SHARD_INDEX=$shard&& '
+                       '$test $args > $out.log 2>&1 && type nul > $out || (type $out.log && exit /b 1)"')
+        writer.rule('test', command, description='TEST $test [$shard/$shards]', pool='test_pool')
+        writer.newline()
+
+    def generate_ninja_build(self, writer):
+        target = format_variables(self.name)
+        test = format_variables(self.test)
+        writer.comment('=== build test target: {target} ==='.format(target=target))
+        writer.build(target, 'test', inputs=test, implicit_outputs=target + '.log',
+                     variables={'test':test, 'args':' '.join(self.args), 'shard':str(self.shard), 'shards':str(self.shards)})
+        writer.newline()
+
+# ({test: runtime}, total runtime of the tests) of the configuration being generated
+TestRuntimes = None
+
+def collect_test_runtimes():
+    """Historical runtime of every test program in milliseconds, from .ninja_log.
+
+    The log keeps the stamps of the old shard counts until ninja recompacts it,
+    only the shards of the most recently run count are summed.
+    """
+    pattern = re.compile(r'(.*)\.shard\d+of(\d+)' + re.escape(TEST_STAMP_EXTENSION) + '$')
+    groups = {}
+    for output, entry in read_ninja_log().items():
+        m = pattern.match(output)
+        if m:
+            # the times are relative to the start of each ninja run, compare the mtimes
+            runtime, mtime = groups.get(m.groups(), (0, 0))
+            groups[m.groups()] = (runtime + entry[1] - entry[0], max(mtime, entry[2]))
+    latest = {}
+    for (test, shards), (runtime, mtime) in groups.items():
+        if test not in latest or mtime > latest[test][1]:
+            latest[test] = (runtime, mtime)
+    runtimes = dict((test, runtime) for test, (runtime, mtime) in latest.items())
+    tests = [format_variables(t.name) for t in Targets if isinstance(t, TestTarget)]
+    return runtimes, sum(runtimes.get(test, 0) for test in tests)
+
+def get_test_runtimes():
+    return TestRuntimes if TestRuntimes is not None else collect_test_runtimes()
+
+def get_test_shards(test):
+    """Split a test whose runtime exceeds its fair share of the test pool.
+
+    The wall time of running all tests is bounded below by the total runtime
+    divided by the pool depth, so every shard should take at most that long.
+    """
+    jobs = Args.test_jobs or Args.jobs
+    runtimes, total = get_test_runtimes()
+    runtime = runtimes.get(test, 0)
+    if runtime <= TEST_SHARD_MIN_RUNTIME or jobs <= 1:
+        return 1
+    budget = max(float(total) / jobs, TEST_SHARD_MIN_RUNTIME)
+    return min(jobs, max(1, int(math.ceil(runtime / budget))))
+
 # ======================================
 # User Target
 # ======================================
@@ -582,22 +1476,118 @@ class UserTarget(object):
         super(UserTarget, self).__init__()
         self.__file__ = CurrLodingFilePath
 
-    def generate_vcxproj(self):
+    def get_vcxproj(self):
         vcxproj_filename = self.__class__.__name__ + '.vcxproj'
         vcxproj_filepath = os.path.join(os.path.split(self.__file__)[0], vcxproj_filename)
-        vcxproj = Vcxproj(vcxproj_filepath)
+        return Vcxproj(vcxproj_filepath)
+
+    def generate_vcxproj(self):
+        vcxproj = self.get_vcxproj()
         vcxproj.cxxflags = self.cxxflags
+        vcxproj.configuration_type = self.VCXPROJ_CONFIGURATION_TYPE
         vcxproj.preprocessor_definitions = self.defs
         vcxproj.cl_compile = [os.path.join(os.getcwd(), x) for x in self.srcs]
         vcxproj.additional_include_dirctories = [os.path.join(os.getcwd(), x) for x in self.incs]
         vcxproj.cl_include = [os.path.join(os.getcwd(), x) for x in self.hdrs]
+        vcxproj.pch = self.pch
+        vcxproj.enable_unity = self.enable_unity
 
+        # libraries built by other targets are linked through project references
+        dep_targets = self.get_dep_targets()
+        vcxproj.project_references = [(t.get_vcxproj().filepath, t.get_vcxproj().guid) for t in dep_targets]
+        dep_outputs = set(format_variables(t.name) for t in dep_targets)
         libs = getattr(self, 'libs', None)
         if libs:
-            vcxproj.additional_dependencies = self.libs
+            vcxproj.additional_dependencies = [x for x in format_variables(self.libs) if x not in dep_outputs]
         
         vcxproj.generate()
+        return vcxproj
     
+    def get_dep_targets(self):
+        """The user targets whose outputs this target links."""
+        deps = set(format_variables(getattr(self, 'deps', []) + getattr(self, 'libs', [])))
+        return [t for t in Targets if t is not self and format_variables(t.name) in deps]
+
+    def get_output(self):
+        """The file built for this target."""
+        return format_variables(self.name)
+
+    def generate_object_targets(self, writer, pic=False):
+        """Generate the compile edges of srcs, returns the objects."""
+        if self.enable_modules:
+            return self.generate_module_object_targets(writer, pic)
+
+        pic_flags = ['-fPIC'] if pic else []
+
+        objs = []
+
+        if self.enable_unity:
+            unity_targets = get_unity_targets(self.name + '.unity', self.srcs)
+            for unity_target in unity_targets:
+                unity_target.generate_ninja_build(writer)
+            srcs = [t.name for t in unity_targets]
+        else:
+            srcs = self.srcs
+
+        for src in srcs:
+            if src.endswith('.c'):
+                cxx_target = CcTarget()
+                cxx_target.cflags = self.cflags + pic_flags
+            else:
+                cxx_target = CxxTarget()
+                cxx_target.cxxflags = self.cxxflags + pic_flags
+            cxx_target.name = src + OBJ_EXTENSION
+            cxx_target.incs = self.incs
+            cxx_target.defs = self.defs
+            cxx_target.src = src
+            cxx_target.generate_ninja_build(writer)
+            objs.append(cxx_target.name)
+        return objs
+
+    def generate_module_object_targets(self, writer, pic=False):
+        # module units can not be merged into unity files, enable_unity is ignored
+        if os.name != 'posix' or toolchain.get_compiler_id('cxx') != 'gcc':
+            print('C++20 modules are only supported with gcc:', self.name)
+            sys.exit(1)
+        pic_flags = ['-fPIC'] if pic else []
+
+        collate_target = ModuleCollateTarget()
+        collate_target.name = self.get_modules_path()
+        collate_target.deps = [t.get_modules_path() + '.json' for t in self.get_dep_targets() if t.enable_modules]
+
+        objs = []
+        for src in self.srcs:
+            if src.endswith('.c'):
+                cxx_target = CcTarget()
+                cxx_target.cflags = self.cflags + pic_flags
+            else:
+                cxx_target = CxxModuleTarget()
+                cxx_target.cxxflags = self.cxxflags + pic_flags
+                cxx_target.dyndep = collate_target.name + '.dd'
+                cxx_target.module_map = collate_target.name + '.map'
+
+                scan_target = ModuleScanTarget()
+                scan_target.name = os.path.join('{BUILD_DIR}', src + '.ddi')
+                scan_target.src = src
+                scan_target.obj = os.path.join('{BUILD_DIR}', src + OBJ_EXTENSION)
+                scan_target.generate_ninja_build(writer)
+                collate_target.scans.append(scan_target.name)
+            cxx_target.name = src + OBJ_EXTENSION
+            cxx_target.incs = self.incs
+            cxx_target.defs = self.defs
+            cxx_target.src = src
+            cxx_target.generate_ninja_build(writer)
+            objs.append(cxx_target.name)
+
+        collate_target.generate_ninja_build(writer)
+        return objs
+
+    def get_modules_path(self):
+        path = self.name + '.modules'
+        if not path.startswith('{BUILD_DIR}'):
+            path = os.path.join('{BUILD_DIR}', path)
+        return path
+
     def init_from_default_build_setting(self):
         if default_build_setting:
             for k in default_build_setting.EXPORT:
@@ -609,6 +1599,8 @@ class UserTarget(object):
 # Exe Target
 # ======================================
 class ExeTarget(UserTarget):
+    VCXPROJ_CONFIGURATION_TYPE = 'Application'
+
     def __init__(self):
         super(ExeTarget, self).__init__()
         Targets.append(self)
@@ -625,34 +1617,13 @@ class ExeTarget(UserTarget):
         self.libs = []      # 链接的库文件
 
         self.enable_unity = False # 是否开启unity编译
+        self.enable_modules = False # 是否开启C++20 modules编译
+        self.pch = None           # 预编译头文件, 目前只用于.vcxproj
         self.init_from_default_build_setting()
 
     def generate_ninja_build(self, writer):
-        objs = []
+        objs = self.generate_object_targets(writer)
 
-        if self.enable_unity:
-            unity_targets = get_unity_targets(self.name + '.unity', self.srcs)
-            for unity_target in unity_targets:
-                unity_target.generate_ninja_build(writer)
-            srcs = [t.name for t in unity_targets]
-        else:
-            srcs = self.srcs
-        
-        for src in srcs:
-            if src.endswith('.c'):
-                cxx_target = CcTarget()
-                cxx_target.cflags = self.cflags
-            else:
-                cxx_target = CxxTarget()
-                cxx_target.cxxflags = self.cxxflags
-            cxx_target.name = src + OBJ_EXTENSION
-            cxx_target.cxxflags = self.cxxflags
-            cxx_target.incs = self.incs
-            cxx_target.defs = self.defs
-            cxx_target.src = src
-            cxx_target.generate_ninja_build(writer)
-            objs.append(cxx_target.name)
-        
         link_target = LinkTarget()
         link_target.name = self.name
         link_target.deps = self.deps
@@ -665,6 +1636,8 @@ class ExeTarget(UserTarget):
 # Shared Library Target
 # ======================================
 class SharedLibraryTarget(UserTarget):
+    VCXPROJ_CONFIGURATION_TYPE = 'DynamicLibrary'
+
     def __init__(self):
         super(SharedLibraryTarget, self).__init__()
         Targets.append(self)
@@ -681,41 +1654,21 @@ class SharedLibraryTarget(UserTarget):
         self.libs = []      # 链接的库文件
 
         self.enable_unity = False # 是否开启unity编译
+        self.enable_modules = False # 是否开启C++20 modules编译
+        self.pch = None           # 预编译头文件, 目前只用于.vcxproj
         self.init_from_default_build_setting()
     
     def generate_ninja_build(self, writer):
-        objs = []
+        objs = self.generate_object_targets(writer)
 
-        if self.enable_unity:
-            unity_targets = get_unity_targets(self.name + '.unity', self.srcs)
-            for unity_target in unity_targets:
-                unity_target.generate_ninja_build(writer)
-            srcs = [t.name for t in unity_targets]
-        else:
-            srcs = self.srcs
-
-        for src in srcs:
-            if src.endswith('.c'):
-                cxx_target = CcTarget()
-                cxx_target.cflags = self.cflags
-            else:
-                cxx_target = CxxTarget()
-                cxx_target.cxxflags = self.cxxflags
-            cxx_target.name = src + OBJ_EXTENSION
-            cxx_target.incs = self.incs
-            cxx_target.defs = self.defs
-            cxx_target.src = src
-            cxx_target.generate_ninja_build(writer)
-            objs.append(cxx_target.name)
-        
-        link_target = LinkTarget()
-        link_target.name = self.name
-        link_target.deps = self.deps
-        link_target.ldflags = self.ldflags
         if os.name == 'posix':
-            link_target.ldflags += ['-shared']
+            link_target = SolinkTarget()
+            link_target.ldflags = self.ldflags + ['-shared']
         elif os.name == 'nt':
-            link_target.ldflags += ['/DLL']
+            link_target = LinkTarget()
+            link_target.ldflags = self.ldflags + ['/DLL']
+        link_target.name = self.name
+        link_target.deps = self.deps
         link_target.libs = self.libs
         link_target.objs = objs
         link_target.generate_ninja_build(writer)
@@ -724,6 +1677,8 @@ class SharedLibraryTarget(UserTarget):
 # Static Library Target
 # ======================================
 class StaticLibraryTarget(UserTarget):
+    VCXPROJ_CONFIGURATION_TYPE = 'StaticLibrary'
+
     def __init__(self):
         super(StaticLibraryTarget, self).__init__()
         Targets.append(self)
@@ -737,39 +1692,62 @@ class StaticLibraryTarget(UserTarget):
         self.srcs = []      # 源文件列表
 
         self.enable_unity = False # 是否开启unity编译
+        self.enable_modules = False # 是否开启C++20 modules编译
+        self.pch = None           # 预编译头文件, 目前只用于.vcxproj
         self.init_from_default_build_setting()
     
+    def get_output(self):
+        if is_component_build():
+            return format_variables(os.path.splitext(self.name)[0] + '.so')
+        return format_variables(self.name)
+
     def generate_ninja_build(self, writer):
-        objs = []
+        if is_component_build():
+            objs = self.generate_object_targets(writer, pic=True)
+
+            link_target = SolinkTarget()
+            link_target.name = self.get_output()
+            link_target.ldflags = ['-shared', '-Wl,-soname,' + os.path.basename(link_target.name)]
+            link_target.objs = objs
+            link_target.generate_ninja_build(writer)
+            return
 
-        if self.enable_unity:
-            unity_targets = get_unity_targets(self.name + '.unity', self.srcs)
-            for unity_target in unity_targets:
-                unity_target.generate_ninja_build(writer)
-            srcs = [t.name for t in unity_targets]
-        else:
-            srcs = self.srcs
+        objs = self.generate_object_targets(writer)
 
-        for src in srcs:
-            if src.endswith('.c'):
-                cxx_target = CcTarget()
-                cxx_target.cflags = self.cflags
-            else:
-                cxx_target = CxxTarget()
-                cxx_target.cxxflags = self.cxxflags
-            cxx_target.name = src + OBJ_EXTENSION
-            cxx_target.cxxflags = self.cxxflags
-            cxx_target.incs = self.incs
-            cxx_target.defs = self.defs
-            cxx_target.src = src
-            cxx_target.generate_ninja_build(writer)
-            objs.append(cxx_target.name)
-        
         archives_target = ArchivesTarget()
         archives_target.name = self.name
         archives_target.objs = objs
         archives_target.generate_ninja_build(writer)
 
+# ======================================
+# Test Target
+# ======================================
+class TestTarget(ExeTarget):
+    def __init__(self):
+        super(TestTarget, self).__init__()
+
+        self.args = []      # 运行参数
+        self.shards = 0     # 分片数量(gtest sharding), 0表示根据历史运行时间自动分片
+
+    def get_test_stamps(self):
+        test = format_variables(self.name)
+        shards = self.shards if self.shards > 0 else get_test_shards(test)
+        return [test + '.shard{0}of{1}'.format(i, shards) + TEST_STAMP_EXTENSION for i in range(shards)]
+
+    def generate_ninja_build(self, writer):
+        super(TestTarget, self).generate_ninja_build(writer)
+
+        stamps = self.get_test_stamps()
+        for i, stamp in enumerate(stamps):
+            test_run_target = TestRunTarget()
+            test_run_target.name = stamp
+            test_run_target.test = self.name
+            test_run_target.args = self.args
+            test_run_target.shard = i
+            test_run_target.shards = len(stamps)
+            test_run_target.generate_ninja_build(writer)
+        return stamps
+
 # ======================================
 # Load module
 # ======================================
@@ -786,25 +1764,1707 @@ def __load_module(module_name, file_path):
     except ImportError:
         import imp
         mod = imp.load_source(module_name, file_path)
-    
-    CurrLodingFilePath = None
+
+    finally:
+        CurrLodingFilePath = None
 
     return mod
 
 CurrLodingFilePath = None
 
+# BUILD.py file path => module name
+BuildModules = {}
+
+def load_default_build_setting():
+    global default_build_setting
+    BuildFileCacheBaseKeys.clear()
+    try:
+        if default_build_setting is None:
+            import default_build_setting
+        else:
+            default_build_setting = reload_module(default_build_setting)
+    except ImportError:
+        pass
+
+def load_build_file(file_path):
+    """Execute a BUILD.py, replacing the targets it defined before."""
+    for target in Targets:
+        if target.__file__ == file_path:
+            ConfigurationTargets.pop(target, None)
+    Targets[:] = [t for t in Targets if t.__file__ != file_path]
+    GlobRecords[file_path] = []
+    TypeDependentBuildFiles.discard(file_path)
+    if file_path not in BuildModules:
+        BuildModules[file_path] = '__build_target%s' % (len(BuildModules) + 1)
+    if not load_cached_build_file(file_path):
+        __load_module(BuildModules[file_path], file_path)
+        cache_build_file(file_path)
+    if Args.configs and file_path in TypeDependentBuildFiles:
+        load_configuration_targets(file_path)
+
+def load_configuration_targets(file_path):
+    """Execute a BUILD.py reading Args.type again for the other build types of
+    --configs, it must define the same targets in every build type."""
+    saved = list(Targets)
+    targets = [t for t in Targets if t.__file__ == file_path]
+    records = GlobRecords[file_path]
+    try:
+        for build_type in Args.configs[1:]:
+            switch_build_setting(build_type)
+            Targets[:] = [t for t in saved if t.__file__ != file_path]
+            GlobRecords[file_path] = []
+            if not load_cached_build_file(file_path):
+                __load_module(BuildModules[file_path], file_path)
+                cache_build_file(file_path)
+            records += GlobRecords[file_path]
+            variants = [t for t in Targets if t.__file__ == file_path]
+            if [type(t).__name__ for t in variants] != [type(t).__name__ for t in targets]:
+                print('{0} must define the same targets for every build type of --configs'.format(os.path.relpath(file_path)))
+                sys.exit(1)
+            for target, variant in zip(targets, variants):
+                ConfigurationTargets.setdefault(target, {})[build_type] = variant
+    finally:
+        switch_build_setting(Args.configs[0])
+        Targets[:] = saved
+        GlobRecords[file_path] = records
+
+def unload_build_file(file_path):
+    for target in Targets:
+        if target.__file__ == file_path:
+            ConfigurationTargets.pop(target, None)
+    Targets[:] = [t for t in Targets if t.__file__ != file_path]
+    BuildModules.pop(file_path, None)
+    GlobRecords.pop(file_path, None)
+    TypeDependentBuildFiles.discard(file_path)
+    name = os.path.relpath(file_path)
+    for key in list(get_build_file_cache()):
+        if key == name or key.startswith(name + '@'):
+            del get_build_file_cache()[key]
+
+def load_build_files():
+    for path, dirs, files in os.walk(os.getcwd()):
+        for file in files:
+            if file == 'BUILD.py':
+                load_build_file(os.path.join(path, file))
+    save_build_file_cache()
+
+# ======================================
+# Build File Cache
+# ======================================
+# The targets defined by a BUILD.py are cached, the BUILD.py is only executed
+# again when it, configure.py, default_build_setting.py or the options change,
+# or when its glob_files() calls match other files now.
+BUILD_FILE_CACHE = os.path.join(CACHE_DIR, 'build_files.json')
+
+# BUILD.py file path => {'key':..., 'targets':[...], 'globs':[...]}
+BuildFileCache = None
+
+# build type => hash of the inputs shared by all the BUILD.py files
+BuildFileCacheBaseKeys = {}
+
+def get_build_file_base_key():
+    if Args.type not in BuildFileCacheBaseKeys:
+        h = hashlib.sha1()
+        paths = [os.path.abspath(__file__)]
+        if default_build_setting:
+            paths.append(os.path.splitext(default_build_setting.__file__)[0] + '.py')
+        for path in paths:
+            with open(path, 'rb') as f:
+                h.update(f.read())
+        # BUILD.py may ask the toolchain for its features
+        tools = [toolchain.get_tool_key(toolchain.get_tool(tool)) for tool in ['cc', 'cxx', 'ld', 'ar']]
+        options = [Args.type, Args.link_mode, Args.time_trace, CC, CXX, LD, AR, tools, get_exported_settings()]
+        h.update(json.dumps(options, sort_keys=True, default=str).encode('utf-8'))
+        BuildFileCacheBaseKeys[Args.type] = h.hexdigest()
+    return BuildFileCacheBaseKeys[Args.type]
+
+def get_build_file_cache_name(file_path):
+    """The cache entry of a BUILD.py, the other build types of --configs have their own."""
+    name = os.path.relpath(file_path)
+    if Args.configs and Args.type != Args.configs[0]:
+        name += '@' + Args.type
+    return name
+
+def get_build_file_key(file_path):
+    h = hashlib.sha1(get_build_file_base_key().encode('utf-8'))
+    with open(file_path, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+def get_build_file_cache():
+    global BuildFileCache
+    if BuildFileCache is None:
+        BuildFileCache = {}
+        if os.path.exists(BUILD_FILE_CACHE):
+            try:
+                with open(BUILD_FILE_CACHE) as f:
+                    BuildFileCache = json.load(f)
+            except ValueError:
+                pass
+    return BuildFileCache
+
+def save_build_file_cache():
+    if BuildFileCache is None:
+        return
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    with open(BUILD_FILE_CACHE + '.tmp', 'w') as f:
+        json.dump(BuildFileCache, f, sort_keys=True)
+    os.replace(BUILD_FILE_CACHE + '.tmp', BUILD_FILE_CACHE)
+
+def describe_target(target):
+    """The class and attributes of a target, None if it can not be cached:
+    its class overrides methods, or its attributes are not plain data."""
+    bases = [TestTarget, ExeTarget, SharedLibraryTarget, StaticLibraryTarget]
+    for cls in type(target).__mro__:
+        if cls in bases:
+            break
+        if any(not (k.startswith('__') and k.endswith('__')) for k in cls.__dict__):
+            return None
+    attributes = dict((k, v) for k, v in target.__dict__.items() if k != '__file__')
+    try:
+        if json.loads(json.dumps(attributes)) != attributes:
+            return None
+    except (TypeError, ValueError):
+        return None
+    return {'class':type(target).__name__, 'base':cls.__name__, 'attributes':attributes}
+
+def restore_target(description, file_path):
+    base = globals()[description['base']]
+    cls = base
+    if description['class'] != base.__name__:
+        # the name of the user class is used by the .vcxproj files
+        cls = type(str(description['class']), (base,), {})
+    target = cls.__new__(cls)
+    target.__dict__.update(description['attributes'])
+    target.__file__ = file_path
+    Targets.append(target)
+
+def cache_build_file(file_path):
+    descriptions = [describe_target(t) for t in Targets if t.__file__ == file_path]
+    name = get_build_file_cache_name(file_path)
+    if None in descriptions:
+        get_build_file_cache().pop(name, None)
+        return
+    globs = [list(r) for r in GlobRecords.get(file_path, [])]
+    get_build_file_cache()[name] = {'key':get_build_file_key(file_path), 'targets':descriptions, 'globs':globs,
+                                    'reads_type':file_path in TypeDependentBuildFiles}
+
+def load_cached_build_file(file_path):
+    """Restore the targets of a BUILD.py from the cache, returns False if it
+    has to be executed."""
+    entry = get_build_file_cache().get(get_build_file_cache_name(file_path))
+    if not entry or entry['key'] != get_build_file_key(file_path):
+        return False
+
+    global CurrLodingFilePath
+    CurrLodingFilePath = file_path
+    try:
+        for patterns, excludes, dirs, files in entry['globs']:
+            if glob_files(patterns, excludes) != files:
+                GlobRecords[file_path] = []
+                return False
+    finally:
+        CurrLodingFilePath = None
+
+    for description in entry['targets']:
+        restore_target(description, file_path)
+    if entry.get('reads_type'):
+        TypeDependentBuildFiles.add(file_path)
+    return True
+
+# ======================================
+# Glob
+# ======================================
+# glob_files() is the glob of BUILD.py: every directory is listed once per run
+# and the globs are recorded, so build.ninja is generated again when a file
+# matching them is added or removed.
+GLOBS_FILE = os.path.join(CACHE_DIR, 'globs.json')
+
+# directory => [(name, is_dir)]
+DirectoryListings = {}
+
+# BUILD.py file path => [(patterns, excludes, listed directories, files)]
+GlobRecords = {}
+
+def list_directory(directory):
+    if directory not in DirectoryListings:
+        try:
+            names = sorted(os.listdir(directory or os.curdir))
+        except OSError:
+            names = []
+        DirectoryListings[directory] = [(name, os.path.isdir(os.path.join(directory, name))) for name in names]
+    return DirectoryListings[directory]
+
+def walk_directories(directory, dirs):
+    result = [directory]
+    dirs.append(directory)
+    for name, is_dir in list_directory(directory):
+        if is_dir and not name.startswith('.'):
+            result += walk_directories(os.path.join(directory, name), dirs)
+    return result
+
+def glob_pattern(pattern, dirs):
+    """Expand a glob pattern, '**' matches any number of directories. The
+    listed directories are appended to dirs."""
+    parts = re.split(r'[\\/]', pattern)
+    paths = ['']
+    if parts[0] == '':
+        paths, parts = [os.sep], parts[1:]
+    if parts[-1] == '**':
+        parts.append('*')
+    for i, part in enumerate(parts):
+        last = i == len(parts) - 1
+        matches = []
+        for path in paths:
+            if part == '**':
+                matches += walk_directories(path, dirs)
+            elif glob.has_magic(part):
+                dirs.append(path)
+                for name, is_dir in list_directory(path):
+                    if name.startswith('.') and not part.startswith('.'):
+                        continue
+                    if (last or is_dir) and fnmatch.fnmatch(name, part):
+                        matches.append(os.path.join(path, name))
+            else:
+                path = os.path.join(path, part)
+                if os.path.isdir(path) or (last and os.path.exists(path)):
+                    matches.append(path)
+        paths = matches
+    return paths
+
+def glob_files(patterns, excludes=None):
+    """Return the sorted files matching any of the patterns, but none of the
+    excludes. '**' in a pattern matches any number of directories, excludes
+    are fnmatch patterns of the whole path."""
+    patterns = list(as_list(patterns))
+    excludes = list(as_list(excludes))
+    dirs = []
+    files = set()
+    for pattern in patterns:
+        files.update(glob_pattern(pattern, dirs))
+    files = sorted(f for f in files if not any(fnmatch.fnmatch(f, e) for e in excludes))
+    if CurrLodingFilePath:
+        dirs = sorted(set(d or os.curdir for d in dirs))
+        GlobRecords.setdefault(CurrLodingFilePath, []).append((patterns, excludes, dirs, files))
+    return files
+
+def get_globbed_directories():
+    return sorted(set(d for records in GlobRecords.values() for r in records for d in r[2]))
+
+def save_glob_records():
+    """Write the recorded globs, keep the file untouched if they are the same."""
+    globs = [[r[0], r[1], r[3]] for build_file in sorted(GlobRecords) for r in GlobRecords[build_file]]
+    content = json.dumps({'globs':globs}, indent=1)
+    if os.path.exists(GLOBS_FILE):
+        with open(GLOBS_FILE) as f:
+            if f.read() == content:
+                return
+    if not os.path.isdir(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    with open(GLOBS_FILE, 'w') as f:
+        f.write(content)
+
+def check_globs(path=GLOBS_FILE):
+    """Touch the globs file if a recorded glob matches other files now."""
+    try:
+        with open(path) as f:
+            globs = json.load(f)['globs']
+    except (IOError, OSError, ValueError, KeyError):
+        # removed by 'ninja -t clean' or by hand: build.ninja writes it again
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(json.dumps({'globs':[]}))
+        return 0
+    if any(glob_files(patterns, excludes) != files for patterns, excludes, files in globs):
+        os.utime(path, None)
+    return 0
+
+def get_changed_globs_build_files(path):
+    """The BUILD.py files globbing the directory of path, whose globs match
+    other files now. None if no glob lists the directory."""
+    directory = os.path.relpath(os.path.dirname(path))
+    DirectoryListings.clear()
+    build_files = None
+    for build_file, records in GlobRecords.items():
+        for patterns, excludes, dirs, files in records:
+            if directory not in dirs:
+                continue
+            build_files = build_files or set()
+            if glob_files(patterns, excludes) != files:
+                build_files.add(build_file)
+    return build_files
+
+def get_configure_script():
+    python = sys.executable if ' ' not in sys.executable else '"{0}"'.format(sys.executable)
+    return '{0} {1}'.format(python, os.path.relpath(os.path.abspath(__file__)))
+
+def get_configure_command():
+    """The command line generating the same build.ninja again."""
+    command = [get_configure_script(), 'gen']
+    if Args.configs:
+        command += ['--configs'] + Args.configs
+    else:
+        command += ['--type', Args.type]
+    if Args.use_distcc:
+        command += ['--use-distcc', 'True']
+    if Args.use_ccache:
+        command += ['--use-ccache', 'True']
+    command += ['-j', str(Args.jobs)]
+    if Args.test_jobs:
+        command += ['--test-jobs', str(Args.test_jobs)]
+    if Args.link_mode != 'static':
+        command += ['--link-mode', Args.link_mode]
+    if Args.time_trace:
+        command += ['--time-trace']
+    if Args.resource_usage:
+        command += ['--resource-usage']
+    return ' '.join(command)
+
+class GlobCheckTarget(object):
+    """Check the recorded globs when a globbed directory changes. The globs file
+    is only touched if they match other files, so writing a depfile or an
+    object in a source directory doesn't regenerate build.ninja."""
+
+    def __init__(self):
+        super(GlobCheckTarget, self).__init__()
+
+        self.name = GLOBS_FILE  # 记录glob结果的文件
+        self.dirs = []          # glob列出的目录
+
+    @classmethod
+    def generate_ninja_rule(cls, writer):
+        writer.rule('glob_check', escape(get_configure_script()) + ' check-globs $out', description='CHECK GLOBS', restat=True)
+        writer.newline()
+
+    def generate_ninja_build(self, writer):
+        writer.build(self.name, 'glob_check', implicit=self.dirs)
+        # a removed directory checks the globs again instead of failing the build
+        for path in self.dirs:
+            writer.build(path, 'phony')
+        writer.newline()
+
+class ConfigureTarget(object):
+    def __init__(self):
+        super(ConfigureTarget, self).__init__()
+
+        self.name = 'build.ninja'   # 生成的ninja文件
+        self.build_files = []       # configure.py, default_build_setting.py和BUILD.py
+
+    @classmethod
+    def generate_ninja_rule(cls, writer):
+        writer.rule('configure', escape(get_configure_command()), description='CONFIGURE', generator=True)
+        writer.newline()
+
+    def generate_ninja_build(self, writer):
+        writer.comment('=== regenerate build.ninja ===')
+        writer.build(self.name, 'configure', implicit=self.build_files + [GLOBS_FILE])
+        # a removed BUILD.py regenerates build.ninja instead of failing the build
+        for path in self.build_files:
+            writer.build(path, 'phony')
+        writer.newline()
+
+# ======================================
+# Configurations
+# ======================================
+# build type => values of default_build_setting.EXPORT, used by --configs
+ConfigurationSettings = {}
+
+# build type => the variables of default_build_setting
+ConfigurationModules = {}
+
+# target => {build type: the target defined by its BUILD.py in that build type}
+ConfigurationTargets = {}
+
+def get_exported_settings():
+    settings = {}
+    if default_build_setting:
+        for k in default_build_setting.EXPORT:
+            if type(k) is str and k in default_build_setting.__dict__:
+                v = default_build_setting.__dict__[k]
+                settings[k] = list(v) if type(v) is list else v
+    return settings
+
+def load_configuration_settings():
+    """Evaluate default_build_setting for each of --configs.
+
+    BUILD.py files are loaded with the first configuration, the other
+    configurations are applied on top of them by apply_configuration. A
+    BUILD.py reading Args.type is executed again for each configuration.
+    """
+    ConfigurationSettings.clear()
+    ConfigurationModules.clear()
+    for build_type in reversed(Args.configs):
+        Args.type = build_type
+        load_default_build_setting()
+        ConfigurationSettings[build_type] = get_exported_settings()
+        if default_build_setting:
+            ConfigurationModules[build_type] = dict(default_build_setting.__dict__)
+    setup_variables()
+
+def switch_build_setting(build_type):
+    """Make Args.type and default_build_setting those of build_type."""
+    Args.type = build_type
+    if default_build_setting:
+        default_build_setting.__dict__.clear()
+        default_build_setting.__dict__.update(ConfigurationModules[build_type])
+
+def apply_configuration(build_type):
+    """Switch the loaded targets to build_type, returns the values to restore."""
+    for target in Targets:
+        if '{BUILD_DIR}' not in target.name:
+            print('Target name must contain {BUILD_DIR} when using --configs:', target.name)
+            sys.exit(1)
+    Args.type = build_type
+    Variables['BUILD_DIR'] = get_build_dir(build_type)
+    base = ConfigurationSettings[Args.configs[0]]
+    settings = ConfigurationSettings[build_type]
+    saved = []
+    for target in Targets:
+        variant = ConfigurationTargets.get(target, {}).get(build_type)
+        if variant is not None:
+            # defined by its BUILD.py in this build type
+            for k, v in variant.__dict__.items():
+                if k != '__file__':
+                    saved.append((target, k, getattr(target, k, None)))
+                    setattr(target, k, v)
+            continue
+        for k, v in settings.items():
+            base_v = base.get(k)
+            if k not in target.__dict__ or type(v) is not list or type(base_v) is not list:
+                continue
+            removed = [x for x in base_v if x not in v]
+            added = [x for x in v if x not in base_v]
+            if not removed and not added:
+                continue
+            value = getattr(target, k)
+            if type(value) is not list or any(x not in value for x in base_v):
+                # overridden by BUILD.py instead of extending the default
+                continue
+            saved.append((target, k, value))
+            setattr(target, k, [x for x in value if x not in removed] + [x for x in added if x not in value])
+    return saved
+
+def restore_configuration(saved):
+    for target, k, v in saved:
+        setattr(target, k, v)
+    Args.type = Args.configs[0]
+    setup_variables()
+
+# ======================================
+# Generate
+# ======================================
+def generate_ninja():
+    """Returns the content of build.ninja and the build graph."""
+    global CurrGeneratingTarget, LinkLibraries, TestRuntimes
+
+    out = StringIO()
+    writer = GraphWriter(out)
+    writer.comment('build.nija generated by configure.py')
+    writer.newline()
+
+    # generate rules
+    CcTarget.generate_ninja_rule(writer)
+    CxxTarget.generate_ninja_rule(writer)
+    LinkTarget.generate_ninja_rule(writer)
+    SolinkTarget.generate_ninja_rule(writer)
+    ArchivesTarget.generate_ninja_rule(writer)
+    UnityTarget.generate_ninja_rule(writer)
+    if any(t.enable_modules for t in Targets):
+        CxxModuleTarget.generate_ninja_rule(writer)
+        ModuleScanTarget.generate_ninja_rule(writer)
+        ModuleCollateTarget.generate_ninja_rule(writer)
+    TestRunTarget.generate_ninja_rule(writer)
+    if Args.resource_usage and os.name == 'posix':
+        write_resource_script()
+    GlobCheckTarget.generate_ninja_rule(writer)
+    ConfigureTarget.generate_ninja_rule(writer)
+
+    # generate builds
+    stamps = []
+    if Args.configs:
+        for build_type in Args.configs:
+            saved = apply_configuration(build_type)
+            try:
+                LinkLibraries = collect_link_libraries()
+                TestRuntimes = collect_test_runtimes()
+                for target in Targets:
+                    CurrGeneratingTarget = target
+                    stamps += target.generate_ninja_build(writer) or []
+                writer.comment('=== build configuration: {0} ==='.format(build_type))
+                writer.build(build_type, 'phony', inputs=[t.get_output() for t in Targets])
+                writer.newline()
+            finally:
+                # the targets stay usable after an error in --watch
+                CurrGeneratingTarget = None
+                LinkLibraries = None
+                TestRuntimes = None
+                restore_configuration(saved)
+        writer.default(Args.configs)
+    else:
+        try:
+            LinkLibraries = collect_link_libraries()
+            TestRuntimes = collect_test_runtimes()
+            for target in Targets:
+                CurrGeneratingTarget = target
+                stamps += target.generate_ninja_build(writer) or []
+        finally:
+            CurrGeneratingTarget = None
+            LinkLibraries = None
+            TestRuntimes = None
+        # tests only run on demand
+        if Targets:
+            writer.default([t.get_output() for t in Targets])
+            writer.newline()
+
+    writer.build('test', 'phony', inputs=stamps)
+    writer.newline()
+
+    # regenerate build.ninja when its inputs change
+    glob_check_target = GlobCheckTarget()
+    glob_check_target.dirs = get_globbed_directories()
+    glob_check_target.generate_ninja_build(writer)
+    configure_target = ConfigureTarget()
+    configure_target.build_files = [os.path.relpath(os.path.abspath(__file__))]
+    if default_build_setting:
+        configure_target.build_files.append(os.path.relpath(os.path.splitext(default_build_setting.__file__)[0] + '.py'))
+    configure_target.build_files += sorted(os.path.relpath(f) for f in BuildModules)
+    configure_target.generate_ninja_build(writer)
+
+    content = out.getvalue()
+    out.close()
+    return content, writer
+
+def write_build_ninja(content):
+    """Write the recorded globs and build.ninja, keep them untouched if the
+    content is the same."""
+    save_glob_records()
+    if os.path.exists('build.ninja'):
+        with open('build.ninja') as f:
+            if f.read() == content:
+                # newer than the BUILD.py files again, see refresh_build_ninja_log
+                os.utime('build.ninja', None)
+                return False
+    with open('build.ninja', 'w+') as f:
+        f.write(content)
+    return True
+
+def refresh_build_ninja_log():
+    """ninja regenerates build.ninja when its inputs are newer than the mtime
+    recorded in .ninja_log at its last regeneration, not the mtime of the
+    file. Record the build.ninja written by configure.py itself, so ninja
+    doesn't run the configure edge again."""
+    if not os.path.exists('.ninja_log'):
+        return
+    p = subprocess.Popen([NINJA, '-t', 'restat', 'build.ninja'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    p.communicate()
+
+def get_executor(args):
+    executor = args.executor
+    if executor == 'auto':
+        executor = 'ninja' if is_ninja_usable() else 'python'
+        if executor == 'python':
+            print('configure.py: can not run {0}, building with the python executor'.format(NINJA))
+    return executor
+
+def run_ninja(args, graph):
+    if get_executor(args) == 'python':
+        executor = Executor(graph, args.jobs)
+        if args.rebuild:
+            executor.clean()
+        return executor.build(['test'] if args.test else graph.defaults)
+
+    refresh_build_ninja_log()
+    if args.rebuild:
+        p = subprocess.Popen(NINJA + ' -t clean', shell=True)
+        p.communicate()
+    p = subprocess.Popen(NINJA + ' -j{0}'.format(args.jobs) + (' test' if args.test else ''), shell=True)
+    p.communicate()
+    return p.returncode
+
+# ======================================
+# Executor
+# ======================================
+# Runs the build graph without ninja, for the hosts where the bundled ninja
+# binary is missing or can not be executed. It follows what ninja does for the
+# features used by configure.py: mtimes and command changes decide the dirty
+# edges, gcc/msvc deps are recorded in its own build log, restat outputs keep
+# the dependents clean and dyndep files are loaded once they are built.
+EXECUTOR_LOG = os.path.join(CACHE_DIR, 'build_log.json')
+MSVC_DEPS_PREFIX = 'Note: including file:'
+
+def is_ninja_usable():
+    try:
+        p = subprocess.Popen([NINJA, '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        p.communicate()
+    except OSError:
+        # missing, not executable, or built for another platform (ENOEXEC)
+        return False
+    return p.returncode == 0
+
+def shell_escape(path):
+    """Quote a path of $in or $out for the shell as ninja does."""
+    if os.name == 'nt':
+        return '"{0}"'.format(path) if ' ' in path or '"' in path else path
+    if re.match(r'^[A-Za-z0-9_+\-./]*$', path):
+        return path
+    return "'" + path.replace("'", "'\\''") + "'"
+
+def unescape_path(word):
+    return re.sub(r'\$([$ :])', r'\1', word)
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def parse_depfile(content):
+    """Parse a Makefile style depfile, returns the dependencies of all its rules."""
+    deps = []
+    content = content.replace('\\\r\n', ' ').replace('\\\n', ' ')
+    for line in content.splitlines():
+        # the first ':' followed by a space ends the targets, so 'C:\...' survives
+        m = re.search(r':(\s|$)', line)
+        if not m:
+            continue
+        words = re.split(r'(?<!\\)\s+', line[m.end():].strip())
+        deps += [w.replace('\\ ', ' ').replace('\\#', '#').replace('$$', '$') for w in words if w]
+    return deps
+
+def parse_dyndep(content):
+    """Parse a ninja dyndep file, returns {output: (implicit_outputs, implicit_inputs)}."""
+    bindings = {}
+    for line in content.splitlines():
+        if not line.startswith('build '):
+            continue
+        outs, ins = re.split(r'(?<!\$): dyndep', line[len('build '):], 1)
+        outs = outs.split(' | ')
+        ins = ins.split(' | ')
+        split = lambda s: [unescape_path(w) for w in re.split(r'(?<!\$) ', s.strip()) if w]
+        bindings[unescape_path(outs[0].strip())] = (split(outs[1]) if len(outs) > 1 else [],
+                                                    split(ins[1]) if len(ins) > 1 else [])
+    return bindings
+
+class Executor(object):
+    """Build the targets of a GraphWriter with up to `jobs` commands at once."""
+
+    def __init__(self, graph, jobs, log_path=EXECUTOR_LOG):
+        self.graph = graph
+        self.jobs = max(1, jobs)
+        self.log_path = log_path
+        self.log = {}           # 首个输出 -> {'hash', 'deps', 'mtime'}
+        self.producers = {}     # 输出 -> edge
+        self.dyndeps = {}       # dyndep文件 -> 使用它的edges
+        self.implicit = {}      # edge -> dyndep加入的隐式输入
+        self.implicit_outputs = {}  # edge -> dyndep加入的隐式输出
+        self.needed = set()
+        self.waiting = {}       # edge -> 尚未完成的依赖edges
+        self.dependents = {}    # edge -> 依赖它的edges
+        self.done = set()
+        self.ready = []
+        self.failed = False
+        self.finished = 0
+        self.start_mtimes = {}  # edge -> 运行前最新的输入mtime
+        for edge in graph.edges:
+            for output in edge.get_outputs():
+                self.producers[output] = edge
+            if edge.dyndep:
+                self.dyndeps.setdefault(unescape_path(edge.dyndep), []).append(edge)
+        if os.path.exists(log_path):
+            with open(log_path) as f:
+                self.log = json.load(f)
+
+    def save_log(self):
+        if not os.path.isdir(os.path.dirname(self.log_path)):
+            os.makedirs(os.path.dirname(self.log_path))
+        with open(self.log_path + '.tmp', 'w') as f:
+            json.dump(self.log, f)
+        os.replace(self.log_path + '.tmp', self.log_path)
+
+    def get_inputs(self, edge):
+        return edge.get_inputs() + self.implicit.get(edge, [])
+
+    def get_outputs(self, edge):
+        return edge.get_outputs() + self.implicit_outputs.get(edge, [])
+
+    def get_variables(self, edge):
+        def join(paths):
+            return ' '.join(shell_escape(p) for p in paths)
+        # the values of build variables are expanded when they are declared
+        variables = dict((k, expand(v, {})) for k, v in edge.variables.items())
+        variables['in'] = join(edge.inputs)
+        variables['in_newline'] = '\n'.join(edge.inputs)
+        variables['out'] = join(edge.outputs)
+        return variables
+
+    def get_rule_value(self, edge, key):
+        value = self.graph.rules[edge.rule].get(key)
+        if not value or value is True:
+            return value
+        return expand(value, {}, self.get_variables(edge))
+
+    def add_needed(self, edge):
+        if edge in self.needed:
+            return True
+        self.needed.add(edge)
+        self.waiting[edge] = set()
+        for path in self.get_inputs(edge) + edge.order_only:
+            if not self.add_dependency(edge, path):
+                return False
+        if not self.waiting[edge]:
+            self.ready.append(edge)
+        return True
+
+    def add_dependency(self, edge, path):
+        producer = self.producers.get(path)
+        if producer is None:
+            if get_mtime(path) is None:
+                print("configure.py: error: '{0}', needed by '{1}', missing and no known rule to make it"
+                      .format(path, self.get_outputs(edge)[0]))
+                return False
+            return True
+        if not self.add_needed(producer):
+            return False
+        if producer not in self.done:
+            self.waiting[edge].add(producer)
+            self.dependents.setdefault(producer, []).append(edge)
+        return True
+
+    def add_dependency_root(self, target):
+        if target not in self.producers:
+            if get_mtime(target) is not None:
+                return True
+            print("configure.py: error: unknown target '{0}'".format(target))
+            return False
+        return self.add_needed(self.producers[target])
+
+    def load_dyndep(self, path):
+        with open(path) as f:
+            bindings = parse_dyndep(f.read())
+        for edge in self.dyndeps.get(path, []):
+            outputs, inputs = bindings.get(edge.outputs[0], ([], []))
+            self.implicit_outputs[edge] = outputs
+            self.implicit[edge] = inputs
+            for output in outputs:
+                self.producers[output] = edge
+
+    def is_dirty(self, edge, command):
+        rule = self.graph.rules[edge.rule]
+        entry = self.log.get(self.get_outputs(edge)[0])
+        if entry is None:
+            return True
+        if not rule.get('generator') and entry['hash'] != get_command_hash(command):
+            return True
+        inputs = self.get_inputs(edge) + entry.get('deps', [])
+        mtimes = [get_mtime(path) for path in inputs]
+        if None in mtimes:
+            return True
+        outputs = [get_mtime(path) for path in self.get_outputs(edge)]
+        if None in outputs:
+            return True
+        # restat outputs may be older than the inputs they were last built from
+        newest_output = min(outputs)
+        if rule.get('restat'):
+            newest_output = max(newest_output, entry.get('mtime', 0))
+        return any(mtime > newest_output for mtime in mtimes)
+
+    def finish(self, edge):
+        self.done.add(edge)
+        for output in edge.get_outputs():
+            if output in self.dyndeps and get_mtime(output) is not None:
+                self.load_dyndep(output)
+        for dependent in self.dependents.get(edge, []):
+            self.waiting[dependent].discard(edge)
+            if not self.waiting[dependent] and dependent not in self.done:
+                self.ready.append(dependent)
+
+    def prepare(self, edge):
+        """Called when all the dependencies of the edge are done. Returns the
+        command to run, None if the edge is clean."""
+        # the dyndep file may add inputs built by edges not done yet
+        if edge.dyndep and edge not in self.implicit:
+            self.load_dyndep(unescape_path(edge.dyndep))
+        for path in self.implicit.get(edge, []):
+            if not self.add_dependency(edge, path):
+                self.failed = True
+                return None
+        if self.waiting[edge]:
+            return None
+        if edge.rule == 'phony':
+            return None
+        command = self.get_rule_value(edge, 'command')
+        if not self.is_dirty(edge, command):
+            return None
+        return command
+
+    def record(self, edge, command, output, start_mtime):
+        rule = self.graph.rules[edge.rule]
+        entry = {'hash':get_command_hash(command), 'deps':[]}
+        if rule.get('deps') == 'msvc':
+            for line in output.splitlines():
+                if line.startswith(MSVC_DEPS_PREFIX):
+                    entry['deps'].append(line[len(MSVC_DEPS_PREFIX):].strip())
+        depfile = self.get_rule_value(edge, 'depfile')
+        if depfile and os.path.exists(depfile):
+            with open(depfile) as f:
+                entry['deps'] = parse_depfile(f.read())
+            if rule.get('deps') == 'gcc':
+                os.remove(depfile)
+        if rule.get('restat'):
+            entry['mtime'] = start_mtime
+        for output in self.get_outputs(edge):
+            self.log[output] = entry
+
+    async def run_command(self, edge, command):
+        rule = self.graph.rules[edge.rule]
+        for output in self.get_outputs(edge):
+            if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+                try:
+                    os.makedirs(os.path.dirname(output))
+                except OSError:
+                    pass
+        rspfile = self.get_rule_value(edge, 'rspfile')
+        if rspfile:
+            with open(rspfile, 'w') as f:
+                f.write(self.get_rule_value(edge, 'rspfile_content'))
+        p = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        output = (await p.communicate())[0].decode('utf-8', 'replace')
+        if rspfile and p.returncode == 0:
+            os.remove(rspfile)
+        if rule.get('deps') == 'msvc':
+            lines = output.splitlines(True)
+            output = ''.join(l for l in lines if not l.startswith(MSVC_DEPS_PREFIX))
+            return edge, command, p.returncode, output, ''.join(lines)
+        return edge, command, p.returncode, output, output
+
+    def build(self, targets):
+        return asyncio.run(self.build_async(targets))
+
+    async def build_async(self, targets):
+        for target in targets:
+            if not self.add_dependency_root(target):
+                return 1
+        total = len([e for e in self.needed if e.rule != 'phony'])
+        running = set()
+        pools = {}
+        while (self.ready and not self.failed) or running:
+            blocked = []
+            while self.ready and len(running) < self.jobs and not self.failed:
+                edge = self.ready.pop(0)
+                if edge in self.done or edge in self.start_mtimes:
+                    continue
+                # the newest input mtime before running, for the restat outputs
+                start_mtime = max([get_mtime(p) or 0 for p in self.get_inputs(edge)] or [0])
+                command = self.prepare(edge)
+                if command is None:
+                    if not self.waiting[edge] and not self.failed:
+                        self.finish(edge)
+                    continue
+                pool = edge.pool or self.graph.rules[edge.rule].get('pool')
+                if pool and pools.get(pool, 0) >= self.graph.pools.get(pool, 1):
+                    blocked.append(edge)
+                    continue
+                pools[pool] = pools.get(pool, 0) + 1
+                self.finished += 1
+                print('[{0}/{1}] {2}'.format(self.finished, total,
+                                             self.get_rule_value(edge, 'description') or command))
+                sys.stdout.flush()
+                self.start_mtimes[edge] = start_mtime
+                running.add(asyncio.ensure_future(self.run_command(edge, command)))
+            self.ready = blocked + self.ready
+            if not running:
+                break
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                edge, command, returncode, output, raw_output = task.result()
+                pool = edge.pool or self.graph.rules[edge.rule].get('pool')
+                pools[pool] -= 1
+                if returncode != 0:
+                    print('FAILED: ' + ' '.join(self.get_outputs(edge)))
+                    print(command)
+                    self.failed = True
+                if output:
+                    sys.stdout.write(output if output.endswith('\n') else output + '\n')
+                    sys.stdout.flush()
+                if self.failed:
+                    continue
+                self.record(edge, command, raw_output, self.start_mtimes[edge])
+                self.finish(edge)
+        self.save_log()
+        if self.failed:
+            print('configure.py: build stopped: subcommand failed.')
+            return 1
+        if self.finished == 0:
+            print('configure.py: no work to do.')
+        return 0
+
+    def clean(self):
+        """Remove the outputs of all the edges, like `ninja -t clean`."""
+        for path in self.dyndeps:
+            if os.path.exists(path):
+                self.load_dyndep(path)
+        for edge in self.graph.edges:
+            if edge.rule == 'phony' or self.graph.rules[edge.rule].get('generator'):
+                continue
+            for output in self.get_outputs(edge):
+                if os.path.isfile(output):
+                    os.remove(output)
+        self.log = {}
+        self.save_log()
+
+def get_command_hash(command):
+    return hashlib.md5(command.encode('utf-8')).hexdigest()
+
+# ======================================
+# Affected
+# ======================================
+def normalize_path(path):
+    return os.path.normpath(os.path.relpath(os.path.abspath(path)))
+
+def get_dependent_targets(targets):
+    """targets and every user target linking them, directly or not."""
+    dependents = dict((t, []) for t in Targets)
+    for target in Targets:
+        for dep_target in target.get_dep_targets():
+            dependents[dep_target].append(target)
+    result = set()
+    pending = list(targets)
+    while pending:
+        target = pending.pop()
+        if target not in result:
+            result.add(target)
+            pending += dependents[target]
+    return result
+
+def is_deps_missing(edge, deps):
+    """True if ninja has no up to date record of the headers read by edge."""
+    for output in edge.outputs:
+        mtime = get_mtime(output)
+        if output not in deps or mtime is None or mtime > deps[output][1]:
+            return True
+    return False
+
+def get_include_directories(target):
+    """The directories target may include headers from: its include paths and
+    the directories of the sources of target and of the targets it links. The
+    repository root, on the include path of every target, is left out: it
+    would match every file."""
+    directories = format_variables(list(getattr(target, 'incs', [])))
+    pending = [target]
+    linked = set()
+    while pending:
+        t = pending.pop()
+        if t not in linked:
+            linked.add(t)
+            directories += [os.path.dirname(x) for x in format_variables(list(t.srcs))]
+            pending += t.get_dep_targets()
+    return set(normalize_path(x) for x in directories) - set([os.curdir])
+
+def is_in_directories(path, directories):
+    return any(path == d or path.startswith(d + os.sep) for d in directories)
+
+def get_affected_targets(files, graph):
+    """The user targets which must be rebuilt when files change."""
+    files = set(normalize_path(f) for f in files)
+    if any(os.path.basename(f) in ('configure.py', 'default_build_setting.py') for f in files):
+        return list(Targets)
+
+    # targets owning the files in BUILD.py
+    affected = set()
+    sources = set()
+    for target in Targets:
+        owned = set(normalize_path(format_variables(x)) for x in [target.__file__] + target.srcs)
+        if files & owned or any(normalize_path(format_variables(x)) in files for x in getattr(target, 'hdrs', [])):
+            affected.add(target)
+        sources |= owned
+    # the files which may be included
+    headers = files - sources
+
+    # targets whose edges read the files, including the headers recorded by ninja
+    deps = read_ninja_deps()
+    missing = 0
+    include_directories = {}
+    for edge in graph.edges:
+        if edge.owner is None or edge.owner in affected:
+            continue
+        inputs = edge.get_inputs()
+        for output in edge.outputs:
+            inputs = inputs + deps.get(output, ([], 0))[0]
+        if any(normalize_path(x) in files for x in inputs):
+            affected.add(edge.owner)
+        elif graph.rules.get(edge.rule, {}).get('deps') and is_deps_missing(edge, deps):
+            # never built or rebuilt since: any header it may include
+            missing += 1
+            if edge.owner not in include_directories:
+                include_directories[edge.owner] = get_include_directories(edge.owner)
+            if any(is_in_directories(f, include_directories[edge.owner]) for f in headers):
+                affected.add(edge.owner)
+    if missing:
+        print('configure.py: no header dependencies recorded for {0} edges, '
+              'assuming they include the headers in their include and source directories'.format(missing), file=sys.stderr)
+
+    affected = get_dependent_targets(affected)
+    return [t for t in Targets if t in affected]
+
+def get_target_outputs(targets, tests=True):
+    """The ninja targets building (and testing) targets in every build type."""
+    global TestRuntimes
+    outputs = []
+    for build_type in Args.configs or [Args.type]:
+        saved = apply_configuration(build_type) if Args.configs else None
+        TestRuntimes = collect_test_runtimes()
+        for target in targets:
+            outputs.append(target.get_output())
+            if tests and isinstance(target, TestTarget):
+                outputs += target.get_test_stamps()
+        TestRuntimes = None
+        if saved is not None:
+            restore_configuration(saved)
+    return outputs
+
+# ======================================
+# Explain
+# ======================================
+# The commands of the edges are kept at every generation, so `explain` can
+# tell which flags changed since the command recorded in .ninja_log (only its
+# hash is there).
+COMMANDS_FILE = os.path.join(CACHE_DIR, 'commands.json')
+# commands kept for every output
+COMMANDS_HISTORY = 3
+
+COMPILE_RULES = ['cc', 'cxx', 'cxx_module']
+LINK_RULES = ['link', 'solink', 'ar']
+
+def murmur_hash64a(data, seed=0xDECAFBADDECAFBAD):
+    """The hash of the commands in .ninja_log."""
+    m = 0xc6a4a7935bd1e995
+    r = 47
+    mask = 0xFFFFFFFFFFFFFFFF
+    length = len(data)
+    h = (seed ^ (length * m)) & mask
+    nblocks = length // 8
+    for k in struct.unpack_from('<%dQ' % nblocks, data):
+        k = (k * m) & mask
+        k ^= k >> r
+        k = (k * m) & mask
+        h ^= k
+        h = (h * m) & mask
+    tail = bytearray(data[nblocks * 8:])
+    if tail:
+        for i in range(len(tail) - 1, -1, -1):
+            h ^= tail[i] << (8 * i)
+        h = (h * m) & mask
+    h ^= h >> r
+    h = (h * m) & mask
+    h ^= h >> r
+    return h
+
+def get_edge_command(executor, edge):
+    """The command of the edge hashed by ninja, with the rspfile content."""
+    command = executor.get_rule_value(edge, 'command')
+    if executor.get_rule_value(edge, 'rspfile'):
+        command += ';rspfile=' + executor.get_rule_value(edge, 'rspfile_content')
+    return command
+
+def save_edge_commands(graph):
+    try:
+        with open(COMMANDS_FILE) as f:
+            commands = json.load(f)
+    except (IOError, OSError, ValueError):
+        commands = {}
+    executor = Executor(graph, 1)
+    changed = False
+    for edge in graph.edges:
+        if edge.rule == 'phony' or graph.rules[edge.rule].get('generator'):
+            continue
+        command = get_edge_command(executor, edge)
+        history = commands.get(edge.outputs[0], [])
+        if not history or history[-1] != command:
+            commands[edge.outputs[0]] = [c for c in history if c != command][-(COMMANDS_HISTORY - 1):] + [command]
+            changed = True
+    if changed:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        with open(COMMANDS_FILE, 'w') as f:
+            json.dump(commands, f)
+
+def get_command_change(rule, old, new):
+    """Describe the flags added and removed from old to new."""
+    if old is None:
+        return 'command of {0} changed (the previous command is unknown)'.format(rule)
+    # the wrapper of --resource-usage has the command in its rspfile
+    changes = []
+    old_wrapped = ';rspfile=' in old
+    new_wrapped = ';rspfile=' in new
+    if old_wrapped != new_wrapped:
+        changes.append('+--resource-usage' if new_wrapped else '---resource-usage')
+    old_words = old.split(';rspfile=', 1)[-1].split()
+    new_words = new.split(';rspfile=', 1)[-1].split()
+    changes += ['-' + w for w in old_words if w not in new_words]
+    changes += ['+' + w for w in new_words if w not in old_words]
+    return 'command of {0}: {1}'.format(rule, ' '.join(changes) or 'reordered')
+
+def explain(graph, targets):
+    """Without building, find the edges ninja would run and the root causes:
+    the changed files and commands which made them dirty."""
+    log = read_ninja_log()
+    deps = read_ninja_deps()
+    try:
+        with open(COMMANDS_FILE) as f:
+            commands = json.load(f)
+    except (IOError, OSError, ValueError):
+        commands = {}
+    executor = Executor(graph, 1)
+    for path in executor.dyndeps:
+        if os.path.exists(path):
+            executor.load_dyndep(path)
+
+    # historical cost of the edges, the average of the rule if never built
+    durations = {}
+    for edge in graph.edges:
+        if edge.outputs[0] in log:
+            start, end = log[edge.outputs[0]][:2]
+            durations.setdefault(edge.rule, []).append(end - start)
+    def get_cost(edge):
+        if edge.outputs[0] in log:
+            return log[edge.outputs[0]][1] - log[edge.outputs[0]][0]
+        costs = durations.get(edge.rule)
+        return sum(costs) / len(costs) if costs else 0
+
+    causes = {}     # edge => root causes, empty if clean
+    def get_causes(edge):
+        if edge in causes:
+            return causes[edge]
+        causes[edge] = result = set()
+        inputs = executor.get_inputs(edge)
+        for path in inputs:
+            producer = executor.producers.get(path)
+            if producer is not None:
+                result.update(get_causes(producer))
+        if edge.rule == 'phony':
+            return result
+
+        rule = graph.rules[edge.rule]
+        outputs = executor.get_outputs(edge)
+        entry = log.get(outputs[0])
+        mtimes = [get_mtime(path) for path in outputs]
+        if None in mtimes:
+            result.add('missing outputs')
+            return result
+        if entry is None and not rule.get('generator'):
+            result.add('not in .ninja_log')
+            return result
+        if not rule.get('generator'):
+            command = get_edge_command(executor, edge)
+            if '%x' % murmur_hash64a(command.encode('utf-8')) != entry[3]:
+                history = commands.get(outputs[0], [])
+                old = [c for c in history if '%x' % murmur_hash64a(c.encode('utf-8')) == entry[3]]
+                result.add(get_command_change(edge.rule, old[0] if old else None, command))
+        output_mtime = min(mtimes)
+        if rule.get('restat') and entry:
+            output_mtime = entry[2]
+        if rule.get('deps'):
+            if outputs[0] not in deps or deps[outputs[0]][1] < output_mtime:
+                result.add('header dependencies not recorded')
+            else:
+                inputs = inputs + deps[outputs[0]][0]
+        for path in inputs:
+            producer = executor.producers.get(path)
+            if producer is not None and causes.get(producer):
+                continue
+            mtime = get_mtime(path)
+            if mtime is None:
+                result.add('deleted: ' + path)
+            elif mtime > output_mtime:
+                result.add('modified: ' + path)
+        return result
+
+    # the edges needed by the targets
+    edges = []
+    visited = set()
+    def visit(edge):
+        if edge in visited:
+            return
+        visited.add(edge)
+        for path in executor.get_inputs(edge) + edge.order_only:
+            if path in executor.producers:
+                visit(executor.producers[path])
+        edges.append(edge)
+    for target in targets:
+        if target not in executor.producers:
+            print("unknown target '{0}'".format(target))
+            return 1
+        visit(executor.producers[target])
+
+    summary = {}    # root cause => (compile edges, link edges, other edges, cost)
+    dirty = []
+    for edge in edges:
+        if edge.rule == 'phony' or not get_causes(edge):
+            continue
+        dirty.append(edge)
+        kind = 0 if edge.rule in COMPILE_RULES else 1 if edge.rule in LINK_RULES else 2
+        for cause in get_causes(edge):
+            counts = summary.setdefault(cause, [0, 0, 0, 0])
+            counts[kind] += 1
+            counts[3] += get_cost(edge)
+
+    total = len([e for e in edges if e.rule != 'phony'])
+    if not dirty:
+        print('all {0} edges are up to date'.format(total))
+        return 0
+    cost = sum(get_cost(e) for e in dirty) / 1000.0
+    print('{0} of {1} edges are dirty, about {2:.1f}s of work, {3:.1f}s with -j{4}'.format(
+        len(dirty), total, cost, cost / max(1, Args.jobs), Args.jobs))
+    print('(restat outputs such as .TOC may stop part of it)')
+    print('')
+    print('{0:>9} {1:>8} {2:>6} {3:>6}  {4}'.format('cost s', 'compile', 'link', 'other', 'root cause'))
+    for cause, (compiles, links, others, cost) in sorted(summary.items(), key=lambda x: (-x[1][3], x[0])):
+        print('{0:>9.1f} {1:>8} {2:>6} {3:>6}  {4}'.format(cost / 1000.0, compiles, links, others, cause))
+    return 0
+
+# ======================================
+# Shard
+# ======================================
+# `shard N` splits the build into N manifests for N builders, balanced by the
+# historical cost of the edges. A shard builds the objects and libraries of
+# its user targets and copies the outputs needed by other shards into
+# SHARD_DIR/exchange; the final manifest copies them back and links the
+# executables, links the libraries depending on other shards and runs the
+# tests. Every manifest has its own builddir for .ninja_log and .ninja_deps.
+SHARD_DIR = '.shards'
+SHARD_EXCHANGE_DIR = os.path.join(SHARD_DIR, 'exchange')
+
+def get_shard_log():
+    """.ninja_log of the full build, updated by the logs of the shards."""
+    log = dict(read_ninja_log())
+    for path in sorted(glob.glob(os.path.join(SHARD_DIR, '*', '.ninja_log'))):
+        log.update(read_ninja_log(path))
+    return log
+
+def get_shard_units():
+    """Group the user targets built by the same shard: a module target
+    imports the modules of its dependencies while compiling."""
+    units = dict((t, t) for t in Targets)
+    def find(t):
+        while units[t] is not t:
+            t = units[t]
+        return t
+    for target in Targets:
+        if target.enable_modules:
+            for dep in target.get_dep_targets():
+                if dep.enable_modules:
+                    units[find(dep)] = find(target)
+    return dict((t, find(t)) for t in Targets)
+
+def is_final_edge(edge):
+    """The edges of the final step: executables, tests and phony targets."""
+    if edge.owner is None or edge.rule in ('phony', 'test'):
+        return True
+    return edge.rule == 'link' and isinstance(edge.owner, ExeTarget)
+
+def partition_graph(graph, count):
+    """Returns {edge: shard index, None for the final step} and the costs of the shards."""
+    log = get_shard_log()
+    durations = {}
+    for edge in graph.edges:
+        if edge.outputs[0] in log:
+            durations.setdefault(edge.rule, []).append(log[edge.outputs[0]][1] - log[edge.outputs[0]][0])
+    def get_cost(edge):
+        if edge.outputs[0] in log:
+            return log[edge.outputs[0]][1] - log[edge.outputs[0]][0]
+        costs = durations.get(edge.rule)
+        # never built: the average of the rule, or count the edges
+        return sum(costs) / len(costs) if costs else 1
+
+    # longest processing time first: the heaviest unit goes to the lightest shard
+    units = get_shard_units()
+    unit_costs = {}
+    for edge in graph.edges:
+        if graph.rules.get(edge.rule, {}).get('generator') or is_final_edge(edge):
+            continue
+        unit = units[edge.owner]
+        unit_costs[unit] = unit_costs.get(unit, 0) + get_cost(edge)
+    costs = [0] * count
+    unit_shards = {}
+    for unit in sorted(unit_costs, key=lambda u: -unit_costs[u]):
+        shard = costs.index(min(costs))
+        unit_shards[unit] = shard
+        costs[shard] += unit_costs[unit]
+
+    producers = {}
+    for edge in graph.edges:
+        for output in edge.get_outputs():
+            producers[output] = edge
+
+    # an edge needing the outputs of another shard moves to the final step
+    shards = {}
+    def place(edge):
+        if edge in shards:
+            return shards[edge]
+        shard = None if is_final_edge(edge) else unit_shards[units[edge.owner]]
+        shards[edge] = shard
+        for path in edge.get_inputs() + edge.order_only:
+            if path in producers and place(producers[path]) != shard:
+                shard = None
+        if shards[edge] is not None and shard is None:
+            costs[shards[edge]] -= get_cost(edge)
+        shards[edge] = shard
+        return shard
+    for edge in graph.edges:
+        if not graph.rules.get(edge.rule, {}).get('generator'):
+            place(edge)
+    return shards, costs
+
+def write_shard_manifest(path, builddir, graph, edges, copies, defaults):
+    """Write a manifest of the edges and the copies {destination: source},
+    returns it as a GraphWriter."""
+    out = StringIO()
+    writer = GraphWriter(out, width=None)
+    writer.variable('builddir', builddir)
+    writer.newline()
+
+    rules = sorted(set(e.rule for e in edges if e.rule != 'phony'))
+    pools = set(graph.rules[r]['pool'] for r in rules if graph.rules[r]['pool'])
+    for name in sorted(pools):
+        writer.pool(name, graph.pools[name])
+    for name in rules:
+        writer.rule(name, **graph.rules[name])
+    if os.name == 'posix':
+        writer.rule('shard_copy', 'cp -p $in $out', description='COPY $out')
+    elif os.name == 'nt':
+        writer.rule('shard_copy', 'cmd /c copy /y $in $out > nul', description='COPY $out')
+    writer.newline()
+
+    for destination, source in sorted(copies.items()):
+        writer.build(destination, 'shard_copy', inputs=source)
+    for edge in edges:
+        writer.build(edge.outputs, edge.rule, edge.inputs, edge.implicit, edge.order_only,
+                     edge.variables, edge.implicit_outputs, edge.pool, edge.dyndep)
+    writer.default(defaults)
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(out.getvalue())
+    return writer
+
+def generate_shards(graph, count):
+    """Write the manifests of the shards and of the final step, returns
+    [(manifest path, GraphWriter)], the final step last."""
+    shards, costs = partition_graph(graph, count)
+    producers = {}
+    for edge in shards:
+        for output in edge.get_outputs():
+            producers[output] = edge
+
+    # the outputs of a shard used by another shard or the final step
+    exchanged = set()
+    for edge, shard in shards.items():
+        for path in edge.get_inputs() + edge.order_only:
+            producer = producers.get(path)
+            if producer is not None and shards[producer] is not None and shards[producer] != shard:
+                exchanged.add(producer)
+    exports = {}
+    for edge in exchanged:
+        for output in edge.get_outputs():
+            exports[output] = os.path.join(SHARD_EXCHANGE_DIR, output)
+
+    manifests = []
+    for i in range(count):
+        edges = [e for e in graph.edges if e in shards and shards[e] == i]
+        copies = dict((exports[o], o) for e in edges if e in exchanged for o in e.get_outputs())
+        path = os.path.join(SHARD_DIR, 'shard{0}.ninja'.format(i))
+        defaults = [o for e in edges for o in e.outputs] + sorted(copies)
+        writer = write_shard_manifest(path, os.path.join(SHARD_DIR, 'shard{0}'.format(i)), graph, edges, copies, defaults)
+        manifests.append((path, writer))
+        print('shard {0}: {1} targets, {2} edges, {3} exported files, about {4:.1f}s'.format(
+            i, len(set(e.owner for e in edges)), len(edges), len(copies), costs[i] / 1000.0))
+
+    edges = [e for e in graph.edges if e in shards and shards[e] is None]
+    copies = dict((o, s) for o, s in exports.items())
+    path = os.path.join(SHARD_DIR, 'final.ninja')
+    writer = write_shard_manifest(path, os.path.join(SHARD_DIR, 'final'), graph, edges, copies, graph.defaults)
+    manifests.append((path, writer))
+    print('final: {0} edges, {1} imported files'.format(len(edges), len(copies)))
+    return manifests
+
+def run_shards(args, manifests):
+    """Run the shards as parallel local builds, then the final step."""
+    jobs = max(1, args.jobs // max(1, len(manifests) - 1))
+    if get_executor(args) == 'python':
+        executors = [Executor(writer, jobs, os.path.join(SHARD_DIR, 'shard{0}'.format(i), 'build_log.json'))
+                     for i, (path, writer) in enumerate(manifests[:-1])]
+        async def build_shards():
+            return await asyncio.gather(*[e.build_async(e.graph.defaults) for e in executors])
+        if any(asyncio.run(build_shards())):
+            return 1
+        path, writer = manifests[-1]
+        executor = Executor(writer, args.jobs, os.path.join(SHARD_DIR, 'final', 'build_log.json'))
+        return executor.build(['test'] if args.test else writer.defaults)
+
+    processes = [subprocess.Popen([NINJA, '-f', path, '-j{0}'.format(jobs)]) for path, writer in manifests[:-1]]
+    if any([p.wait() for p in processes]):
+        return 1
+    p = subprocess.Popen([NINJA, '-f', manifests[-1][0], '-j{0}'.format(args.jobs)] + (['test'] if args.test else []))
+    return p.wait()
+
+# ======================================
+# Watch
+# ======================================
+# how long the tree must be quiet before a rebuild is triggered, in seconds
+WATCH_DEBOUNCE = 0.3
+WATCH_POLL_INTERVAL = 1.0
+# files written by configure.py and ninja themselves
+WATCH_IGNORE = ['*.d', '*.tmp', '*.pyc', '*.vcxproj', '*.sln', '*.pch.cpp', 'build.ninja', '.ninja_*', 'gen_unity_source.py', MODULE_SCRIPT, RESOURCE_SCRIPT]
+
+def is_watch_ignored(path):
+    parts = os.path.relpath(path).split(os.sep)
+    if any(part.startswith('.') or part == '__pycache__' for part in parts[:-1]):
+        return True
+    return any(fnmatch.fnmatch(parts[-1], pattern) for pattern in WATCH_IGNORE)
+
+class InotifyWatcher(object):
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_ISDIR = 0x40000000
+    EVENT_STRUCT = struct.Struct('iIII')
+
+    def __init__(self, root):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.dirs = {}      # watch descriptor => directory
+        self.add_tree(root)
+
+    def add_tree(self, root):
+        mask = (self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM |
+                self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE)
+        for path, dirs, files in os.walk(root):
+            dirs[:] = [d for d in dirs if not d.startswith('.') and d != '__pycache__']
+            wd = self.libc.inotify_add_watch(self.fd, path.encode(), mask)
+            if wd >= 0:
+                self.dirs[wd] = path
+
+    def wait(self, timeout):
+        """Return the changed files as {path: 'modified'|'created'|'deleted'}."""
+        changes = {}
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changes
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT_STRUCT.unpack_from(data, offset)
+            offset += self.EVENT_STRUCT.size
+            name = data[offset:offset+length].rstrip(b'\0').decode()
+            offset += length
+            if wd not in self.dirs:
+                continue
+            path = os.path.join(self.dirs[wd], name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.add_tree(path)
+                continue
+            if is_watch_ignored(path):
+                continue
+            if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                changes[path] = 'created'
+            elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                changes[path] = 'deleted'
+            else:
+                changes.setdefault(path, 'modified')
+        return changes
+
+class PollingWatcher(object):
+    def __init__(self, root):
+        self.root = root
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for path, dirs, files in os.walk(self.root):
+            dirs[:] = [d for d in dirs if not d.startswith('.') and d != '__pycache__']
+            for file in files:
+                file_path = os.path.join(path, file)
+                if is_watch_ignored(file_path):
+                    continue
+                try:
+                    st = os.stat(file_path)
+                except OSError:
+                    continue
+                snapshot[file_path] = (st.st_mtime, st.st_size)
+        return snapshot
+
+    def wait(self, timeout):
+        """Return the changed files as {path: 'modified'|'created'|'deleted'}."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL if deadline is None else min(WATCH_POLL_INTERVAL, max(0, deadline - time.time())))
+            snapshot = self.scan()
+            changes = {}
+            for path in set(snapshot) | set(self.snapshot):
+                if path not in self.snapshot:
+                    changes[path] = 'created'
+                elif path not in snapshot:
+                    changes[path] = 'deleted'
+                elif snapshot[path] != self.snapshot[path]:
+                    changes[path] = 'modified'
+            self.snapshot = snapshot
+            if changes or (deadline is not None and time.time() >= deadline):
+                return changes
+
+def create_watcher(root):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(root)
+
+def get_owner_build_file(path):
+    """The BUILD.py nearest to path, which globs the sources of its directory."""
+    directory = os.path.dirname(path)
+    root = os.getcwd()
+    while True:
+        build_file = os.path.join(directory, 'BUILD.py')
+        if build_file in BuildModules:
+            return build_file
+        if directory == root or os.path.dirname(directory) == directory:
+            return None
+        directory = os.path.dirname(directory)
+
+def save_build_state():
+    """The state of the loaded BUILD.py files, restored when one fails to load."""
+    return (list(Targets), dict(BuildModules), dict(GlobRecords), set(TypeDependentBuildFiles),
+            dict(ConfigurationTargets))
+
+def restore_build_state(state):
+    targets, modules, globs, type_dependent, configuration_targets = state
+    Targets[:] = targets
+    for current, saved in ((BuildModules, modules), (GlobRecords, globs), (ConfigurationTargets, configuration_targets)):
+        current.clear()
+        current.update(saved)
+    TypeDependentBuildFiles.clear()
+    TypeDependentBuildFiles.update(type_dependent)
+
+def print_watch_error(e):
+    # SystemExit is raised after the error is printed, e.g. by format_variables
+    if not isinstance(e, SystemExit):
+        traceback.print_exc(file=sys.stdout)
+
+def reload_build_file(build_file):
+    """load_build_file() in --watch: print the errors and keep the last good
+    targets of build_file."""
+    state = save_build_state()
+    try:
+        load_build_file(build_file)
+    except (Exception, SystemExit) as e:
+        print_watch_error(e)
+        restore_build_state(state)
+        print('configure.py: failed to load {0}, keeping its last good targets'.format(os.path.relpath(build_file)))
+
+def apply_changes(changes):
+    """Re-execute the BUILD.py files affected by changes."""
+    if any(os.path.basename(path) == 'configure.py' for path in changes):
+        print('configure.py changed, please restart the watch')
+    if any(os.path.basename(path) == 'default_build_setting.py' for path in changes):
+        load_default_build_setting()
+        if Args.configs:
+            load_configuration_settings()
+        build_files = list(BuildModules)
+        for build_file in build_files:
+            reload_build_file(build_file)
+        save_build_file_cache()
+        return
+
+    reload_files = set()
+    DirectoryListings.clear()
+    for path, kind in changes.items():
+        if os.path.basename(path) == 'BUILD.py':
+            if kind == 'deleted':
+                unload_build_file(path)
+            else:
+                reload_files.add(path)
+        elif kind != 'modified':
+            # a source file is added or removed
+            build_files = get_changed_globs_build_files(path)
+            if build_files is None:
+                build_files = [get_owner_build_file(path)]
+            reload_files.update(f for f in build_files if f)
+    for build_file in sorted(reload_files):
+        if os.path.exists(build_file):
+            reload_build_file(build_file)
+    save_build_file_cache()
+
+def watch(args):
+    watcher = create_watcher(os.getcwd())
+    print('watching {0} ({1})'.format(os.getcwd(), watcher.__class__.__name__))
+    while True:
+        changes = watcher.wait(None)
+        # debounce: wait until the tree is quiet
+        while True:
+            more = watcher.wait(WATCH_DEBOUNCE)
+            if not more:
+                break
+            changes.update(more)
+        if not changes:
+            continue
+
+        try:
+            apply_changes(changes)
+            content, graph = generate_ninja()
+        except (Exception, SystemExit) as e:
+            print_watch_error(e)
+            print('configure.py: build.ninja is not updated, fix the error to continue')
+            continue
+        write_build_ninja(content)
+        save_edge_commands(graph)
+        run_ninja(args, graph)
+
 # ======================================
 # Main
 # ======================================
 def main():
     parser = argparse.ArgumentParser(description='configure c/c++ build system')
+    parser.add_argument('command', nargs='?', choices=['build', 'gen', 'affected', 'explain', 'shard', 'time-trace', 'resources', 'check-globs'], default='build',
+                        help='build (default); '
+                             'gen: only generate build.ninja; '
+                             'affected FILE...: print the ninja targets to rebuild and retest when FILEs change; '
+                             'explain [TARGET...]: without building, print the changed files and flags which make the targets dirty; '
+                             'shard [N]: split the build into N manifests balanced by .ninja_log and a final one in .shards; '
+                             'time-trace [N]: print the N most expensive includes and instantiations of a --time-trace build; '
+                             'resources [N]: print the N heaviest edges of every target of a --resource-usage build')
+    parser.add_argument('params', nargs='*', help='parameters of the command')
     parser.add_argument('--generate-vcxproj', action='store_true', help='generate visual stdio project file (.vcxproj)')
     parser.add_argument('--type', choices=['debug', 'release'], default='debug', help='default is debug')
+    parser.add_argument('--configs', nargs='+', choices=['debug', 'release'], help='generate all these build types into one build.ninja, overrides --type')
     parser.add_argument('--use-distcc', type=bool, choices=[True, False], help='use distcc', default=False)
     parser.add_argument('--use-ccache', type=bool, choices=[True, False], help='use ccache', default=False)
     parser.add_argument('-j', '--jobs', type=int, help='Allow N jobs at once; default is {0} in this system'.format(os.cpu_count()), default=os.cpu_count())
     parser.add_argument('--rebuild', action='store_true', help='clean and build')
-    args = parser.parse_args()
+    parser.add_argument('--test', action='store_true', help='build and run the test targets')
+    parser.add_argument('--test-jobs', type=int, help='Allow N tests to run at once; default is the same as --jobs')
+    parser.add_argument('--watch', action='store_true', help='keep running, reconfigure and rebuild when files change')
+    parser.add_argument('--link-mode', choices=['static', 'component'], default='static',
+                        help='component: build static libraries as shared libraries in debug builds for faster relinks')
+    parser.add_argument('--time-trace', action='store_true', help='trace the compile time of every source (clang -ftime-trace, gcc -ftime-report)')
+    parser.add_argument('--resource-usage', action='store_true', help='record the cpu time, peak RSS and disk I/O of every compile and link (posix)')
+    parser.add_argument('--run-shards', action='store_true', help='shard: run the shards as parallel local builds, then the final step')
+    parser.add_argument('--executor', choices=['auto', 'ninja', 'python'], default='auto',
+                        help='run the build with ninja or the builtin python executor; auto falls back to python when ninja can not run')
+    args = parser.parse_args(namespace=ArgsNamespace())
+
+    # run by build.ninja to check the globs of BUILD.py
+    if args.command == 'check-globs':
+        return check_globs(*args.params)
 
     global CC, CXX
 
@@ -820,63 +3480,72 @@ def main():
     global Args
     Args = args
 
+    # probe toolchain
+    global toolchain
+    toolchain = Toolchain(os.path.join(CACHE_DIR, 'toolchain.json'))
+    if args.configs:
+        args.configs = [c for i, c in enumerate(args.configs) if c not in args.configs[:i]]
+        args.type = args.configs[0]
+
     # load default setting
-    try:
-        global default_build_setting
-        import default_build_setting
-    except ImportError:
-        pass
+    load_default_build_setting()
 
     # setup variables
     setup_variables()
+    if args.configs:
+        load_configuration_settings()
 
     # load BUILD.py
-    targets_cnt = 0
-    for path, dirs, files in os.walk(os.getcwd()):
-        for file in files:
-            if file == 'BUILD.py':
-                targets_cnt += 1
-                module_name = '__build_target%s' % targets_cnt
-                file_path = os.path.join(path, file)
-                __load_module(module_name, file_path)
+    load_build_files()
     
     # generate .vscproj
     if args.generate_vcxproj:
+        sln = Sln(os.path.basename(os.getcwd()) + '.sln')
         for target in Targets:
-            target.generate_vcxproj()
+            vcxproj = target.generate_vcxproj()
+            dependencies = [t.get_vcxproj().guid for t in target.get_dep_targets()]
+            sln.projects.append((target.__class__.__name__, vcxproj.filepath, vcxproj.guid, dependencies))
+        sln.generate()
         return
 
-    # generate ninja
-    out = StringIO()
-    writer = NinjaWriter(out)
-    writer.comment('build.nija generated by configure.py')
-    writer.newline()
-
-    # generate rules
-    CcTarget.generate_ninja_rule(writer)
-    CxxTarget.generate_ninja_rule(writer)
-    LinkTarget.generate_ninja_rule(writer)
-    ArchivesTarget.generate_ninja_rule(writer)
-    UnityTarget.generate_ninja_rule(writer)
-
-    # generate builds
-    for target in Targets:
-        target.generate_ninja_build(writer)
+    # query the build graph
+    if args.command == 'affected':
+        content, graph = generate_ninja()
+        for output in get_target_outputs(get_affected_targets(args.params, graph)):
+            print(output)
+        return 0
+    elif args.command == 'time-trace':
+        args.time_trace = True
+        content, graph = generate_ninja()
+        return report_time_trace(graph, int(args.params[0]) if args.params else 20)
+    elif args.command == 'explain':
+        content, graph = generate_ninja()
+        return explain(graph, args.params or (['test'] if args.test else graph.defaults))
+    elif args.command == 'shard':
+        content, graph = generate_ninja()
+        manifests = generate_shards(graph, int(args.params[0]) if args.params else 2)
+        return run_shards(args, manifests) if args.run_shards else 0
+    elif args.command == 'resources':
+        content, graph = generate_ninja()
+        return report_resource_usage(graph, int(args.params[0]) if args.params else 10)
 
-    # write to build.ninja
-    with open('build.ninja', 'w+') as f:
-        f.write(out.getvalue())
-    
-    out.close()
+    # generate ninja
+    content, graph = generate_ninja()
+    write_build_ninja(content)
+    save_edge_commands(graph)
+    if args.command == 'gen':
+        return 0
 
     # run ninja
-    if args.rebuild:
-        p = subprocess.Popen(NINJA + ' -t clean'.format(args.jobs), shell=True)
-        p.communicate()
-    p = subprocess.Popen(NINJA + ' -j{0}'.format(args.jobs), shell=True)
-    p.communicate()
-    return p.returncode
+    returncode = run_ninja(args, graph)
+    if args.watch:
+        args.rebuild = False
+        try:
+            watch(args)
+        except KeyboardInterrupt:
+            pass
+    return returncode
 
 
 if __name__ == '__main__':
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
@@ -1,6 +1,6 @@
 # -*- coding=utf-8 -*-
 
-from __main__ import Args
+from __main__ import Args, toolchain
 
 EXPORT = ['cflag', 'cxxflags', 'incs', 'defs', 'ldflags', 'libs', 'deps']
 
@@ -14,5 +14,7 @@ if Args.type == 'release':
 incs = []
 defs = []
 ldflags = []
+if toolchain.ld_supports('-fuse-ld=mold'):
+    ldflags += ['-fuse-ld=mold']
 libs = []
 deps = []
\ No newline at end of file
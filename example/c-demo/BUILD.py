@@ -1,7 +1,6 @@
 # -*- coding=utf-8 -*-
 
-from __main__ import ExeTarget
-import glob
+from __main__ import ExeTarget, glob_files
 import os
 
 class CDemo(ExeTarget):
@@ -12,7 +11,7 @@ class CDemo(ExeTarget):
             self.name = '{BUILD_DIR}/example/c-demo/a.out'
             self.cflags = ['-g']                            # 编译参数
             self.incs = ['example/c-demo/']                 # 头文件搜索路径
-            self.srcs = glob.glob('example/c-demo/*.c')     # 源文件列表
+            self.srcs = glob_files('example/c-demo/*.c')    # 源文件列表
             self.deps = []                                  # 链接的依赖文件
             self.ldflags = []                               # 链接的参数
             self.libs = []                                  # 链接的库文件
@@ -21,7 +20,7 @@ class CDemo(ExeTarget):
             self.name = '{BUILD_DIR}\\example\\c-demo\\a.exe'
             self.cflags = ['/Od']                           # 编译参数
             self.incs = ['example\\c-demo\\']               # 头文件搜索路径
-            self.srcs = glob.glob('example\\c-demo\\*.c')   # 源文件列表
+            self.srcs = glob_files('example\\c-demo\\*.c')  # 源文件列表
             self.deps = []                                  # 链接的依赖文件
             self.ldflags = []                               # 链接的参数
             self.libs = []                                  # 链接的库文件
@@ -1,7 +1,6 @@
 # -*- coding=utf-8 -*-
 
-from __main__ import ExeTarget
-import glob
+from __main__ import ExeTarget, glob_files
 import os
 
 class ExeDemo(ExeTarget):
@@ -12,7 +11,7 @@ class ExeDemo(ExeTarget):
             self.name = '{BUILD_DIR}/example/exe-demo/a.out'
             self.cxxflags = ['-g']                          # 编译参数
             self.incs = ['example/exe-demo/']               # 头文件搜索路径
-            self.srcs = glob.glob('example/exe-demo/*.cpp') # 源文件列表
+            self.srcs = glob_files('example/exe-demo/*.cpp') # 源文件列表
             self.deps = []                                  # 链接的依赖文件
             self.ldflags = []                               # 链接的参数
             self.libs = []                                  # 链接的库文件
@@ -21,7 +20,7 @@ class ExeDemo(ExeTarget):
             self.name = '{BUILD_DIR}\\example\\exe-demo\\a.exe'
             self.cxxflags = ['/Od']                         # 编译参数
             self.incs = ['example\\exe-demo\\']             # 头文件搜索路径
-            self.srcs = glob.glob('example\\exe-demo\\*.cpp') # 源文件列表
+            self.srcs = glob_files('example\\exe-demo\\*.cpp') # 源文件列表
             self.deps = []                                  # 链接的依赖文件
             self.ldflags = []                               # 链接的参数
             self.libs = []                                  # 链接的库文件
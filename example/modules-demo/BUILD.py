@@ -0,0 +1,19 @@
+# -*- coding=utf-8 -*-
+
+from __main__ import ExeTarget, toolchain, glob_files
+import os
+
+class ModulesDemo(ExeTarget):
+    def __init__(self):
+        super(ModulesDemo, self).__init__()
+        
+        self.name = '{BUILD_DIR}/example/modules-demo/modules-demo'
+        self.cxxflags = ['-g', '-std=c++20']            # 编译参数
+        self.incs = []                                  # 头文件搜索路径
+        self.srcs = glob_files('example/modules-demo/*.cpp') # 源文件列表
+        self.deps = ['{BUILD_DIR}/example/modules-demo/lib/libgreet.a'] # 链接的依赖文件
+        self.libs = ['{BUILD_DIR}/example/modules-demo/lib/libgreet.a'] # 链接的库文件
+        self.enable_modules = True                      # 是否开启C++20 modules编译
+
+if os.name == 'posix' and toolchain.get_compiler_id() == 'gcc' and toolchain.cxx_supports('-fmodules-ts'):
+    ModulesDemo()
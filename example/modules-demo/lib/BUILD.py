@@ -0,0 +1,17 @@
+# -*- coding=utf-8 -*-
+
+from __main__ import StaticLibraryTarget, toolchain, glob_files
+import os
+
+class ModulesLibDemo(StaticLibraryTarget):
+    def __init__(self):
+        super(ModulesLibDemo, self).__init__()
+        
+        self.name = '{BUILD_DIR}/example/modules-demo/lib/libgreet.a'
+        self.cxxflags = ['-g', '-std=c++20']            # 编译参数
+        self.incs = []                                  # 头文件搜索路径
+        self.srcs = glob_files('example/modules-demo/lib/*.cpp') # 源文件列表
+        self.enable_modules = True                      # 是否开启C++20 modules编译
+
+if os.name == 'posix' and toolchain.get_compiler_id() == 'gcc' and toolchain.cxx_supports('-fmodules-ts'):
+    ModulesLibDemo()
@@ -0,0 +1,5 @@
+export module greet;
+
+export import :format;
+
+export int greet_count();
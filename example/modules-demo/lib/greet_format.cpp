@@ -0,0 +1,6 @@
+export module greet:format;
+
+export const char* greet_format()
+{
+    return "hello %s from modules-demo\n";
+}
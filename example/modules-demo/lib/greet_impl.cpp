@@ -0,0 +1,6 @@
+module greet;
+
+int greet_count()
+{
+    return 1;
+}
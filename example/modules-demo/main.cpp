@@ -0,0 +1,11 @@
+
+#include <stdio.h>
+
+import greet;
+
+int main()
+{
+    for (int i = 0; i < greet_count(); i++)
+        printf(greet_format(), "world");
+    return 0;
+}
@@ -0,0 +1,24 @@
+# -*- coding=utf-8 -*-
+
+from __main__ import TestTarget, glob_files
+import os
+
+class TestDemo(TestTarget):
+    def __init__(self):
+        super(TestDemo, self).__init__()
+        
+        if os.name == 'posix':
+            self.name = '{BUILD_DIR}/example/test-demo/test-demo'
+            self.cxxflags = ['-g']                          # 编译参数
+            self.incs = []                                  # 头文件搜索路径
+            self.srcs = glob_files('example/test-demo/*.cpp') # 源文件列表
+            self.args = []                                  # 运行参数
+
+        elif os.name == 'nt':
+            self.name = '{BUILD_DIR}\\example\\test-demo\\test-demo.exe'
+            self.cxxflags = ['/Od']                         # 编译参数
+            self.incs = []                                  # 头文件搜索路径
+            self.srcs = glob_files('example\\test-demo\\*.cpp') # 源文件列表
+            self.args = []                                  # 运行参数
+
+TestDemo()
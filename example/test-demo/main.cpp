@@ -0,0 +1,32 @@
+
+#include <stdio.h>
+#include <stdlib.h>
+
+// a gtest-like sharded test: runs the cases of shard GTEST_SHARD_INDEX
+// out of GTEST_TOTAL_SHARDS
+static int add(int a, int b)
+{
+    return a + b;
+}
+
+int main()
+{
+    const char* total_env = getenv("GTEST_TOTAL_SHARDS");
+    const char* index_env = getenv("GTEST_SHARD_INDEX");
+    int total = total_env ? atoi(total_env) : 1;
+    int index = index_env ? atoi(index_env) : 0;
+
+    int failed = 0;
+    for (int i = 0; i < 100; i++)
+    {
+        if (i % total != index)
+            continue;
+        if (add(i, i) != 2 * i)
+        {
+            printf("case %d failed\n", i);
+            failed++;
+        }
+    }
+    printf("shard %d/%d: %d failed\n", index, total, failed);
+    return failed == 0 ? 0 : 1;
+}
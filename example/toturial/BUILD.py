@@ -1,7 +1,6 @@
 # -*- coding=utf-8 -*-
 
-from __main__ import ExeTarget
-import glob
+from __main__ import ExeTarget, glob_files
 import os
 
 class Toturial(ExeTarget):
@@ -12,7 +11,7 @@ class Toturial(ExeTarget):
             self.name = '{BUILD_DIR}/example/toturial/toturial'
             self.cxxflags = ['-g']                          # 编译参数
             self.incs = []                                  # 头文件搜索路径
-            self.srcs = glob.glob('example/toturial/*.cpp') # 源文件列表
+            self.srcs = glob_files('example/toturial/*.cpp') # 源文件列表
             self.deps = [
                 '{BUILD_DIR}/example/staticlib-demo/liby.a',
                 '{BUILD_DIR}/example/sharedlib-demo/libx.so',
@@ -28,7 +27,7 @@ class Toturial(ExeTarget):
             self.name = '{BUILD_DIR}\\example\\toturial\\toturial.exe'
             self.cxxflags = ['/Od']                         # 编译参数
             self.incs = []                                  # 头文件搜索路径
-            self.srcs = glob.glob('example\\toturial\\*.cpp') # 源文件列表
+            self.srcs = glob_files('example\\toturial\\*.cpp') # 源文件列表
             self.deps = [
                 '{BUILD_DIR}\\example\\staticlib-demo\\liby.lib',
             ]
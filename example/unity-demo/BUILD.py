@@ -1,7 +1,6 @@
 # -*- coding=utf-8 -*-
 
-from __main__ import ExeTarget
-import glob
+from __main__ import ExeTarget, glob_files
 import os
 
 class UnityDemo(ExeTarget):
@@ -12,13 +11,13 @@ class UnityDemo(ExeTarget):
             self.name = '{BUILD_DIR1}/example/unity-demo/unity-demo'
             self.cxxflags = self.cxxflags + ['-g']          # 编译参数
             self.incs = []                                  # 头文件搜索路径
-            self.srcs = glob.glob('example/unity-demo/*.cpp') # 源文件列表
+            self.srcs = glob_files('example/unity-demo/*.cpp') # 源文件列表
 
         elif os.name == 'nt':
             self.name = '{BUILD_DIR}\\example\\unity-demo\\unity-demo.exe'
             self.cxxflags = ['/Od']                         # 编译参数
             self.incs = []                                  # 头文件搜索路径
-            self.srcs = glob.glob('example\\unity-demo\\*.cpp') # 源文件列表
+            self.srcs = glob_files('example\\unity-demo\\*.cpp') # 源文件列表
         
         self.enable_unity = True
 